@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+import argparse, contextlib, json, os, platform, statistics, subprocess, sys
+import tempfile, time
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+INSTALL_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, INSTALL_DIR)
+
+import inat_taxonomy, nature_id
+import synthetic_taxonomy, tiny_model
+
+#############################################################################
+#                                                                           #
+# Benchmarks for the stages of the classification pipeline. They run        #
+# offline with a synthetic taxonomy, a matching iNaturalist archive, and a  #
+# tiny generated model, and classify the images in 'plant_images'. Results  #
+# are written as JSON and can be compared with those of earlier commits:    #
+#                                                                           #
+#   benchmarks/run_benchmarks.py -o before.json                             #
+#   ... change code ...                                                     #
+#   benchmarks/run_benchmarks.py -o after.json --compare before.json        #
+#                                                                           #
+#############################################################################
+
+IMAGE_DIRECTORY = os.path.join(INSTALL_DIR, 'plant_images')
+
+# Importing nature_id should take no longer than this. Most of it is spent in
+# numpy and Pillow; TensorFlow Lite and requests are imported on first use.
+IMPORT_BUDGET_MS = 400
+
+# Timings of a stage in milliseconds.
+def summarize(times_ns):
+    times = [t / 1e6 for t in times_ns]
+    return { 'runs'      : len(times),
+             'min_ms'    : min(times),
+             'median_ms' : statistics.median(times),
+             'mean_ms'   : statistics.fmean(times),
+             'max_ms'    : max(times) }
+
+# Runs `function' `repeat' times, returns the summary of the timings. The
+# `setup' function runs before each call and is not timed.
+def measure(function, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter_ns()
+        function()
+        times.append(time.perf_counter_ns() - start)
+    return summarize(times)
+
+def remove_file(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+# Python startup and import of nature_id in a new process.
+def bench_startup(repeat):
+    command = [sys.executable, '-c', 'import nature_id']
+    return measure(lambda: subprocess.run(command, cwd=INSTALL_DIR,
+                                          check=True), repeat)
+
+# Import of nature_id alone, timed in a new process.
+def bench_import(repeat):
+    command = [sys.executable, '-c', 'import time; '
+               'start = time.perf_counter_ns(); import nature_id; '
+               'print(time.perf_counter_ns() - start)']
+    return summarize([int(subprocess.run(command, cwd=INSTALL_DIR, check=True,
+                                         capture_output=True,
+                                         text=True).stdout)
+                      for _ in range(repeat)])
+
+# Taxonomy load from the CSV file and from its binary snapshot.
+def bench_taxonomy(taxonomy_csv, repeat):
+    snapshot = nature_id.Taxonomy.snapshot_filename(taxonomy_csv)
+    results = {}
+    nature_id.scientific_names_only = True
+    try:
+        results['taxonomy_parse'] = measure(
+            lambda: nature_id.Taxonomy().read_taxonomy(taxonomy_csv), repeat,
+            setup=lambda: remove_file(snapshot))
+        results['taxonomy_snapshot'] = measure(
+            lambda: nature_id.Taxonomy().read_taxonomy(taxonomy_csv), repeat)
+    finally:
+        nature_id.scientific_names_only = False
+    return results
+
+# Annotation of the taxa with common names from the archive and from the
+# cache of a model's common names.
+def bench_common_names(taxonomy_csv, repeat):
+    taxonomy = nature_id.Taxonomy()
+    taxonomy.parse_taxonomy(taxonomy_csv)
+    prefix = os.path.splitext(taxonomy_csv)[0]
+    cache = f'{prefix}.common_names.{inat_taxonomy.get_language()}.json'
+    results = {}
+    results['common_names_archive'] = measure(
+        lambda: taxonomy.annotate_common_names(None), repeat)
+    taxonomy.annotate_common_names(prefix)
+    assert os.path.isfile(cache)
+    results['common_names_cache'] = measure(
+        lambda: taxonomy.annotate_common_names(prefix), repeat)
+    return results
+
+# Decode and preprocessing of each image, with and without option -f.
+def bench_images(classifier, images, repeat):
+    results = {}
+    for name, full in [('image_load', False), ('image_load_full', True)]:
+        nature_id.full_decode = full
+        times = []
+        for _ in range(repeat):
+            for image in images:
+                start = time.perf_counter_ns()
+                classifier.load_image(image)
+                times.append(time.perf_counter_ns() - start)
+        results[name] = summarize(times)
+    nature_id.full_decode = False
+    return results
+
+# One call of the interpreter for a batch of images.
+def bench_invoke(model, images, batch_size, repeat):
+    interpreter = nature_id.ModelInterpreter(model, batch_size=batch_size)
+    shape = interpreter.mInput_details[0]['shape'][1:]
+    batch = [np.full(shape, 128, np.uint8)] * batch_size
+    interpreter.invoke(batch) # warm up
+    return { 'invoke' : measure(lambda: interpreter.invoke(batch), repeat) }
+
+# Scores to results for random score vectors.
+def bench_prediction(classifier, num_classes, repeat):
+    rng = np.random.default_rng(0)
+    scores = rng.dirichlet(np.full(num_classes, 0.05),
+                           size=repeat).astype(np.float32)
+    taxonomy = classifier.mTaxonomy
+    results = {}
+    times = []
+    for row in scores:
+        start = time.perf_counter_ns()
+        taxonomy.prediction(row)
+        times.append(time.perf_counter_ns() - start)
+    results['prediction'] = summarize(times)
+    nature_id.label_scores_only = True
+    try:
+        times = []
+        for row in scores:
+            start = time.perf_counter_ns()
+            taxonomy.prediction(row)
+            times.append(time.perf_counter_ns() - start)
+        results['prediction_labels'] = summarize(times)
+    finally:
+        nature_id.label_scores_only = False
+    nature_id.top_k = 10
+    try:
+        times = []
+        for row in scores:
+            start = time.perf_counter_ns()
+            taxonomy.prediction(row)
+            times.append(time.perf_counter_ns() - start)
+        results['prediction_top10'] = summarize(times)
+    finally:
+        nature_id.top_k = 1
+    # restricted to a family like option --within
+    family = np.flatnonzero(taxonomy.rank_levels == 30)[0]
+    taxonomy.restrict(taxonomy.taxon_ids[family])
+    try:
+        times = []
+        for row in scores:
+            start = time.perf_counter_ns()
+            taxonomy.prediction(row)
+            times.append(time.perf_counter_ns() - start)
+        results['prediction_within'] = summarize(times)
+    finally:
+        taxonomy.restrict(inat_taxonomy.ROOT_TAXON_ID)
+    return results
+
+# The whole pipeline, per image.
+def bench_classify(classifier, images, batch_size, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for _ in classifier.classify_images(images, batch_size):
+            pass
+        times.append((time.perf_counter_ns() - start) // len(images))
+    return { 'classify_images' : summarize(times) }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=INSTALL_DIR,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+# Print the median timings of `results' relative to those of `baseline'.
+def compare(results, baseline, stream):
+    print(f"{'stage':24s} {'before ms':>12s} {'after ms':>12s} {'ratio':>8s}",
+          file=stream)
+    for stage, timing in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        before = baseline['stages'][stage]['median_ms']
+        after = timing['median_ms']
+        print(f'{stage:24s} {before:12.3f} {after:12.3f} '
+              f'{after / before if before else float("nan"):8.2f}',
+              file=stream)
+
+def run(args):
+    images = sorted(os.path.join(IMAGE_DIRECTORY, f)
+                    for f in os.listdir(IMAGE_DIRECTORY)
+                    if os.path.splitext(f)[1].lower() in
+                    nature_id.IMAGE_EXTENSIONS)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rows = synthetic_taxonomy.make_taxonomy(args.num_classes)
+        taxonomy_csv = os.path.join(tmpdir, 'taxonomy_synthetic.csv')
+        synthetic_taxonomy.write_taxonomy(taxonomy_csv, rows)
+        archive = os.path.join(tmpdir, 'inaturalist-taxonomy.dwca.zip')
+        synthetic_taxonomy.write_inat_archive(archive, rows)
+        model = os.path.join(tmpdir, 'tiny_model.tflite')
+        tiny_model.write_tiny_model(model, args.num_classes, args.image_size,
+                                    args.quantized)
+
+        inat_taxonomy.INAT_TAXONOMY = archive
+        inat_taxonomy.INAT_TAXONOMY_DB = os.path.splitext(archive)[0] + \
+                                         '.sqlite'
+
+        stages = {}
+        stages['startup'] = bench_startup(args.repeat)
+        stages['import'] = bench_import(args.repeat)
+        stages.update(bench_taxonomy(taxonomy_csv, args.repeat))
+        stages.update(bench_common_names(taxonomy_csv, args.repeat))
+        classifier = nature_id.OfflineClassifier([model, taxonomy_csv],
+                                                 batch_size=args.batch_size)
+        stages.update(bench_images(classifier, images, args.repeat))
+        stages.update(bench_invoke(model, images, args.batch_size,
+                                   args.repeat))
+        stages.update(bench_prediction(classifier, args.num_classes,
+                                       max(args.repeat, 100)))
+        stages.update(bench_classify(classifier, images, args.batch_size,
+                                     args.repeat))
+
+    return { 'commit'     : git_commit(),
+             'time'       : time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+             'python'     : platform.python_version(),
+             'platform'   : platform.platform(),
+             'numpy'      : np.__version__,
+             'parameters' : { 'num_classes' : args.num_classes,
+                              'num_taxa'    : len(rows),
+                              'image_size'  : args.image_size,
+                              'quantized'   : args.quantized,
+                              'batch_size'  : args.batch_size,
+                              'repeat'      : args.repeat,
+                              'images'      : len(images) },
+             'stages'     : stages }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of '
+                                     'nature_id.py offline.')
+    parser.add_argument('-c', '--num_classes', type=int, default=10000,
+                        help='Number of leaf classes of the synthetic '
+                        'taxonomy and model.')
+    parser.add_argument('-i', '--image_size', type=int, default=224,
+                        help='Input size of the model in pixels.')
+    parser.add_argument('-u', '--quantized', action='store_true',
+                        help='Model with uint8 input.')
+    parser.add_argument('-b', '--batch_size', type=int, default=1,
+                        help='Number of images per interpreter call.')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of runs of each stage.')
+    parser.add_argument('-o', '--output', help='Write JSON results to this '
+                        'file instead of stdout.')
+    parser.add_argument('--compare', metavar='FILE', help='Compare with the '
+                        'JSON results of an earlier run.')
+    parser.add_argument('--import_budget', metavar='MS', type=float,
+                        default=IMPORT_BUDGET_MS, help='Fail if the median '
+                        'import of nature_id takes longer; 0 to disable.')
+    args = parser.parse_args()
+
+    # messages of nature_id go to stderr, results to stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f), sys.stderr)
+
+    import_ms = results['stages']['import']['median_ms']
+    if args.import_budget and import_ms > args.import_budget:
+        print(f'Import of nature_id took {import_ms:.1f} ms, more than the '
+              f'budget of {args.import_budget:.1f} ms.', file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import csv, io, random, zipfile
+
+#############################################################################
+#                                                                           #
+# Writes synthetic taxonomies of any size in the format of the taxonomy     #
+# files of the classifiers, and a matching iNaturalist archive with common  #
+# names. Benchmarks use them instead of the real files, which are large and #
+# need to be downloaded.                                                    #
+#                                                                           #
+#############################################################################
+
+RANK_LEVELS = [70, 60, 50, 40, 30, 20, 10] # kingdom ... species
+RANK_NAMES  = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus',
+               'species']
+
+FIRST_TAXON_ID = 100000 # above 48460, the id of the root of the taxonomy
+
+def make_taxonomy(num_leaves, seed=0):
+    """
+    Returns the rows (parent_taxon_id, taxon_id, rank_level, leaf_class_id,
+    name) of a taxonomy with `num_leaves' species as leaf classes. The
+    species are grouped into genera, the genera into families, and so on up
+    to the kingdoms, each group with 1 to 8 members. Parents precede their
+    children.
+    """
+    rng = random.Random(seed)
+    next_id = FIRST_TAXON_ID
+
+    # build the levels bottom-up, each level is a list of groups of children
+    level = list(range(num_leaves))
+    levels = []
+    for _ in RANK_LEVELS[:-1]:
+        groups = []
+        first = 0
+        while first < len(level):
+            size = rng.randint(1, 8)
+            groups.append(level[first:first+size])
+            first += size
+        levels.append(groups)
+        level = list(range(len(groups)))
+    levels.reverse() # now from kingdoms down to genera
+
+    rows = []
+    parent_ids = [''] * len(levels[0]) # kingdoms have no parent
+    for depth, groups in enumerate(levels + [None]):
+        num_taxa = len(groups) if groups is not None else num_leaves
+        ids = list(range(next_id, next_id + num_taxa))
+        next_id += num_taxa
+        for index, taxon_id in enumerate(ids):
+            if depth == len(RANK_LEVELS) - 1:
+                name = f'Genus{parent_ids[index]} species{taxon_id}'
+                leaf_class_id = str(index)
+            else:
+                name = f'{RANK_NAMES[depth].capitalize()}{taxon_id}'
+                leaf_class_id = ''
+            rows.append((parent_ids[index], taxon_id, RANK_LEVELS[depth],
+                         leaf_class_id, name))
+        if groups is not None:
+            # parents of the next level
+            parent_ids = [ids[index] for index, group in enumerate(groups)
+                          for _ in group]
+    return rows
+
+def write_taxonomy(filename, rows):
+    "Write taxonomy in the format of the classifiers' taxonomy files."
+    with open(filename, 'w', newline='', encoding='latin-1') as f:
+        writer = csv.writer(f)
+        writer.writerow(['parent_taxon_id', 'taxon_id', 'rank_level',
+                         'leaf_class_id', 'name'])
+        writer.writerows(rows)
+
+def write_inat_archive(filename, rows, fraction=0.7, seed=0):
+    """
+    Write a zip archive like iNaturalist's 'inaturalist-taxonomy.dwca.zip'
+    with the taxa in `rows' and English common names for about `fraction' of
+    them.
+    """
+    rng = random.Random(seed)
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as zf:
+        taxa = io.StringIO()
+        writer = csv.writer(taxa)
+        writer.writerow(['id', 'taxonID', 'identifier', 'parentNameUsageID',
+                         'kingdom', 'phylum', 'class', 'order', 'family',
+                         'genus', 'specificEpithet', 'infraspecificEpithet',
+                         'modified', 'scientificName', 'taxonRank',
+                         'references'])
+        for parent_id, taxon_id, rank_level, _, name in rows:
+            parent = f'https://www.inaturalist.org/taxa/{parent_id}' \
+                     if parent_id else ''
+            rank = RANK_NAMES[RANK_LEVELS.index(rank_level)]
+            writer.writerow([taxon_id, '', '', parent, '', '', '', '', '', '',
+                             '', '', '', name, rank, ''])
+        zf.writestr('taxa.csv', taxa.getvalue())
+
+        names = io.StringIO()
+        writer = csv.writer(names)
+        writer.writerow(['id', 'vernacularName', 'language', 'locality',
+                         'countryCode', 'source', 'lexicon', 'contributor',
+                         'created'])
+        for _, taxon_id, _, _, name in rows:
+            if rng.random() < fraction:
+                writer.writerow([taxon_id, f'common {name.lower()}', 'en', '',
+                                 '', '', '', '', ''])
+        zf.writestr('VernacularNames-english.csv', names.getvalue())
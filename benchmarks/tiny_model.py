@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import flatbuffers
+
+#############################################################################
+#                                                                           #
+# Writes a tiny TensorFlow Lite classifier without TensorFlow. The model    #
+# averages the pixels of the input image, feeds the three channel means     #
+# through a fully connected layer and a softmax. It runs offline and makes  #
+# benchmarks independent of the real classifiers.                           #
+#                                                                           #
+# Field numbers follow the TFLite flatbuffer schema (schema.fbs).           #
+#                                                                           #
+#############################################################################
+
+# operator codes in enum BuiltinOperator
+DEQUANTIZE      = 6
+FULLY_CONNECTED = 9
+SOFTMAX         = 25
+MEAN            = 40
+
+# union types in BuiltinOptions
+FULLY_CONNECTED_OPTIONS = 8
+SOFTMAX_OPTIONS         = 9
+REDUCER_OPTIONS         = 27
+
+# tensor types in enum TensorType
+TYPE_FLOAT32 = 0
+TYPE_INT32   = 2
+TYPE_UINT8   = 3
+
+def _int_vector(builder, values):
+    builder.StartVector(4, len(values), 4)
+    for value in reversed(values):
+        builder.PrependInt32(value)
+    return builder.EndVector()
+
+def _offset_vector(builder, offsets):
+    builder.StartVector(4, len(offsets), 4)
+    for offset in reversed(offsets):
+        builder.PrependUOffsetTRelative(offset)
+    return builder.EndVector()
+
+def _buffer(builder, data):
+    if data is None:
+        builder.StartObject(1)
+        return builder.EndObject()
+    data = data.tobytes()
+    builder.StartVector(1, len(data), 16)
+    builder.head = builder.head - len(data)
+    builder.Bytes[builder.head:builder.head+len(data)] = data
+    vector = builder.EndVector()
+    builder.StartObject(1)
+    builder.PrependUOffsetTRelativeSlot(0, vector, 0)
+    return builder.EndObject()
+
+def _quantization(builder, scale, zero_point):
+    builder.StartVector(4, 1, 4)
+    builder.PrependFloat32(scale)
+    scale_vector = builder.EndVector()
+    builder.StartVector(8, 1, 8)
+    builder.PrependInt64(zero_point)
+    zero_point_vector = builder.EndVector()
+    builder.StartObject(4)
+    builder.PrependUOffsetTRelativeSlot(2, scale_vector, 0)
+    builder.PrependUOffsetTRelativeSlot(3, zero_point_vector, 0)
+    return builder.EndObject()
+
+def _tensor(builder, name, shape, tensor_type, buffer, quantization=None):
+    name = builder.CreateString(name)
+    shape_vector = _int_vector(builder, shape)
+    builder.StartObject(8)
+    builder.PrependUOffsetTRelativeSlot(0, shape_vector, 0)
+    builder.PrependInt8Slot(1, tensor_type, 0)
+    builder.PrependUint32Slot(2, buffer, 0)
+    builder.PrependUOffsetTRelativeSlot(3, name, 0)
+    if quantization is not None:
+        builder.PrependUOffsetTRelativeSlot(4, quantization, 0)
+    return builder.EndObject()
+
+def _operator(builder, opcode_index, inputs, outputs, options_type=0,
+              options=None):
+    inputs = _int_vector(builder, inputs)
+    outputs = _int_vector(builder, outputs)
+    builder.StartObject(5)
+    builder.PrependUint32Slot(0, opcode_index, 0)
+    builder.PrependUOffsetTRelativeSlot(1, inputs, 0)
+    builder.PrependUOffsetTRelativeSlot(2, outputs, 0)
+    if options is not None:
+        builder.PrependUint8Slot(3, options_type, 0)
+        builder.PrependUOffsetTRelativeSlot(4, options, 0)
+    return builder.EndObject()
+
+def _operator_code(builder, code):
+    builder.StartObject(4)
+    builder.PrependInt8Slot(0, min(code, 127), 0)
+    builder.PrependInt32Slot(2, 1, 1)
+    builder.PrependInt32Slot(3, code, 0)
+    return builder.EndObject()
+
+def make_tiny_model(num_classes, image_size=224, quantized=False, seed=0):
+    """
+    Returns the bytes of a .tflite model with input shape [1, image_size,
+    image_size, 3] and output shape [1, num_classes]. The input is of type
+    float32 or, if `quantized' is set, of type uint8.
+    """
+    rng = np.random.default_rng(seed)
+    weights = (0.05 * rng.standard_normal((num_classes, 3))).astype(np.float32)
+    bias = rng.standard_normal(num_classes).astype(np.float32)
+    axes = np.array([1, 2], dtype=np.int32)
+
+    builder = flatbuffers.Builder(1024 + weights.nbytes + bias.nbytes)
+
+    # buffer 0 is the empty sentinel buffer
+    buffers = [_buffer(builder, None), _buffer(builder, axes),
+               _buffer(builder, weights), _buffer(builder, bias)]
+
+    input_shape = [1, image_size, image_size, 3]
+    tensors = []
+    if quantized:
+        quantization = _quantization(builder, 1.0 / 255.0, 0)
+        tensors.append(_tensor(builder, 'input', input_shape, TYPE_UINT8,
+                               0, quantization))
+        tensors.append(_tensor(builder, 'dequantized', input_shape,
+                               TYPE_FLOAT32, 0))
+    else:
+        tensors.append(_tensor(builder, 'input', input_shape, TYPE_FLOAT32,
+                               0))
+    pixels = len(tensors) - 1
+    tensors.append(_tensor(builder, 'axes', [2], TYPE_INT32, 1))
+    tensors.append(_tensor(builder, 'means', [1, 3], TYPE_FLOAT32, 0))
+    tensors.append(_tensor(builder, 'weights', [num_classes, 3],
+                           TYPE_FLOAT32, 2))
+    tensors.append(_tensor(builder, 'bias', [num_classes], TYPE_FLOAT32, 3))
+    tensors.append(_tensor(builder, 'logits', [1, num_classes],
+                           TYPE_FLOAT32, 0))
+    tensors.append(_tensor(builder, 'scores', [1, num_classes],
+                           TYPE_FLOAT32, 0))
+    axes_t, means, weights_t, bias_t, logits, scores = range(pixels + 1,
+                                                             pixels + 7)
+
+    builder.StartObject(1)
+    builder.PrependBoolSlot(0, False, False)
+    reducer_options = builder.EndObject()
+    builder.StartObject(1)
+    builder.PrependFloat32Slot(0, 1.0, 0.0)
+    softmax_options = builder.EndObject()
+    builder.StartObject(4)
+    fully_connected_options = builder.EndObject()
+
+    operators = []
+    if quantized:
+        operators.append(_operator(builder, 3, [0], [pixels]))
+    operators.append(_operator(builder, 0, [pixels, axes_t], [means],
+                               REDUCER_OPTIONS, reducer_options))
+    operators.append(_operator(builder, 1, [means, weights_t, bias_t],
+                               [logits], FULLY_CONNECTED_OPTIONS,
+                               fully_connected_options))
+    operators.append(_operator(builder, 2, [logits], [scores],
+                               SOFTMAX_OPTIONS, softmax_options))
+
+    tensors = _offset_vector(builder, tensors)
+    operators = _offset_vector(builder, operators)
+    inputs = _int_vector(builder, [0])
+    outputs = _int_vector(builder, [scores])
+    name = builder.CreateString('main')
+    builder.StartObject(5)
+    builder.PrependUOffsetTRelativeSlot(0, tensors, 0)
+    builder.PrependUOffsetTRelativeSlot(1, inputs, 0)
+    builder.PrependUOffsetTRelativeSlot(2, outputs, 0)
+    builder.PrependUOffsetTRelativeSlot(3, operators, 0)
+    builder.PrependUOffsetTRelativeSlot(4, name, 0)
+    subgraph = builder.EndObject()
+
+    codes = [_operator_code(builder, code)
+             for code in [MEAN, FULLY_CONNECTED, SOFTMAX, DEQUANTIZE]]
+
+    codes = _offset_vector(builder, codes)
+    subgraphs = _offset_vector(builder, [subgraph])
+    buffers = _offset_vector(builder, buffers)
+    description = builder.CreateString('nature-id benchmark model')
+    builder.StartObject(5)
+    builder.PrependUint32Slot(0, 3, 0)
+    builder.PrependUOffsetTRelativeSlot(1, codes, 0)
+    builder.PrependUOffsetTRelativeSlot(2, subgraphs, 0)
+    builder.PrependUOffsetTRelativeSlot(3, description, 0)
+    builder.PrependUOffsetTRelativeSlot(4, buffers, 0)
+    model = builder.EndObject()
+    builder.Finish(model, file_identifier=b'TFL3')
+    return bytes(builder.Output())
+
+def write_tiny_model(filename, num_classes, image_size=224, quantized=False):
+    with open(filename, 'wb') as f:
+        f.write(make_tiny_model(num_classes, image_size, quantized))
@@ -1,4 +1,6 @@
-import json, os, pickle, requests, shelve, sys, time
+import collections, concurrent.futures, json, os, sys, threading, time
+import urllib.parse
+import sqlite_cache
 
 #############################################################################
 #                                                                           #
@@ -14,7 +16,11 @@ import json, os, pickle, requests, shelve, sys, time
 
 API_HOST                 = "https://api.inaturalist.org/v1"
 CACHE_EXPIRATION         = 14 * 24 * 3600  # cache expires after 2 weeks
+CACHE_MAX_SIZE           = 64 * 1024 ** 2  # evict entries beyond 64 MB
 TOO_MANY_API_CALLS_DELAY = 60              # wait this long after error 429
+API_MAX_IDS              = 30              # max number of ids per call
+API_MAX_WORKERS          = 8               # max concurrent API calls
+API_TIMEOUT              = 30              # seconds to connect or to read
 
 # The cache stores the json responses.
 
@@ -24,12 +30,66 @@ if sys.platform == 'win32':
 else:
     DATA_DIR  = os.path.join(os.path.expanduser('~'), '.cache', 'inat_api')
 
-if not os.path.exists(DATA_DIR):
-    os.makedirs(DATA_DIR)
+# The cache is an SQLite database, see sqlite_cache. Expired entries are
+# deleted when a response is added.
 
-cache = shelve.open(os.path.join(DATA_DIR, 'api.cache'))
+class ApiCache(sqlite_cache.SqliteCache):
 
-# API call throttling.
+    TABLE = 'cache'
+    SIZE  = 'size'
+
+    def __init__(self, filename, expiration=CACHE_EXPIRATION,
+                 max_size=CACHE_MAX_SIZE):
+        super().__init__(filename, max_size)
+        self.expiration = expiration
+
+    def create_tables(self, db):
+        db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, '
+                   'expires REAL, accessed REAL, size INTEGER, value TEXT)')
+        db.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache '
+                   '(expires)')
+
+    # returns cached json response or None
+    def get(self, key):
+        with self.lock:
+            db = self.connect()
+            tim = time.time()
+            row = db.execute('SELECT value FROM cache WHERE key = ? AND '
+                             'expires > ?', (key, tim)).fetchone()
+            if not row:
+                return None
+            db.execute('UPDATE cache SET accessed = ? WHERE key = ?',
+                       (tim, key))
+            return json.loads(row[0])
+
+    def put(self, key, response):
+        value = json.dumps(response)
+        with self.transaction() as db:
+            tim = time.time()
+            expired = db.execute('SELECT COALESCE(SUM(size), 0) FROM cache '
+                                 'WHERE expires <= ?', (tim,)).fetchone()[0]
+            db.execute('DELETE FROM cache WHERE expires <= ?', (tim,))
+            row = db.execute('SELECT size FROM cache WHERE key = ?',
+                             (key,)).fetchone()
+            db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                       (key, tim + self.expiration, tim, len(value), value))
+            self.add_size(db, len(value) - expired - (row[0] if row else 0))
+            self.evict(db)
+
+cache = ApiCache(os.path.join(DATA_DIR, 'api_cache.sqlite'))
+
+# Canonical cache key for a request, independent of the order of parameters.
+def cache_key(url, params=None):
+    if not params:
+        return url
+    return url + '?' + urllib.parse.urlencode(sorted(params.items()))
+
+# API call throttling. Each call reserves a time slot: immediately while
+# fewer than API_MAX_CALLS calls were made in the last API_INTERVAL, else
+# API_INTERVAL after the call API_MAX_CALLS calls before it. Hence no window
+# of API_INTERVAL holds more than API_MAX_CALLS calls. Threads reserve their
+# slots under a lock and wait for them outside of it. After error 429, no
+# slot is reserved before the backoff ends.
 
 class Throttle:
 
@@ -37,46 +97,137 @@ class Throttle:
     API_INTERVAL  = 60   # 1 minute
 
     def __init__(self):
-        self.callTimes = []   # times of api calls
+        self.lock = threading.Lock()
+        self.callTimes = collections.deque() # times of past and reserved calls
+        self.pauseEnd = 0.0                  # no calls before this time
 
     # wait if necessary to avoid more than API_MAX_CALLS in API_INTERVAL
     def wait(self):
-        while len(self.callTimes) >= self.API_MAX_CALLS:
-            waitTime = self.callTimes[0] - (time.time() - self.API_INTERVAL)
-            if waitTime > 0:
-                print('Throttling API calls, '
-                      f'sleeping for {waitTime:.1f} seconds.')
-                time.sleep(waitTime)
-                continue
-            self.callTimes = self.callTimes[1:]
-        self.callTimes.append(time.time())
+        with self.lock:
+            now = time.monotonic()
+            while self.callTimes and \
+                  self.callTimes[0] <= now - self.API_INTERVAL:
+                self.callTimes.popleft()
+            if len(self.callTimes) < self.API_MAX_CALLS:
+                callTime = now
+            else:
+                callTime = self.callTimes[-self.API_MAX_CALLS] + \
+                           self.API_INTERVAL
+            callTime = max(callTime, self.pauseEnd)
+            self.callTimes.append(callTime)
+            waitTime = callTime - now
+        if waitTime > 0:
+            print('Throttling API calls, '
+                  f'sleeping for {waitTime:.1f} seconds.')
+            time.sleep(waitTime)
+
+    # pause all calls for `seconds' seconds, e.g. after error 429
+    def backoff(self, seconds):
+        with self.lock:
+            self.pauseEnd = max(self.pauseEnd, time.monotonic() + seconds)
 
 api_call_throttle = Throttle()
 
+# HTTP session with a pool of keep-alive connections, shared by threads.
+# Package requests is imported on first use.
+
+session = None
+session_pid = None
+
+def get_session():
+    global session, session_pid
+    if session is None or session_pid != os.getpid():
+        import requests.adapters
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=API_MAX_WORKERS)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session_pid = os.getpid()
+    return session
+
+# API call with throttling, retried after error 429. Returns json response
+# or None on failure.
+def api_request(url, params=None):
+    import requests
+    delay = TOO_MANY_API_CALLS_DELAY
+    headers = {'Content-type' : 'application/json' }
+    while True:
+        api_call_throttle.wait()
+        try:
+            response = get_session().get(url, headers=headers, params=params,
+                                         timeout=API_TIMEOUT)
+        except requests.exceptions.Timeout:
+            print(f"Error: API call '{url}' timed out.")
+            return None
+        if response.status_code == requests.codes.too_many:
+            # all threads pause
+            api_call_throttle.backoff(delay)
+            delay *= 2
+        else:
+            break
+    if response.status_code == requests.codes.ok:
+        return response.json()
+    else:
+        print(response.text)
+        return None
+
+# Returns json response from cache or from API call, None on failure.
+def api_get(url, params=None):
+    key = cache_key(url, params)
+    response = cache.get(key)
+    if response is None:
+        response = api_request(url, params)
+        if response is not None:
+            cache.put(key, response)
+    return response
+
 # argument is an id or a list of id's
 def get_taxa_by_id(id):
     if type(id) is list:
         url = API_HOST + '/taxa/' + '%2C'.join([str(i) for i in id])
     else:
         url = API_HOST + f'/taxa/{id}'
-    tim = time.time()
-    if not url in cache or cache[url][0] < tim - CACHE_EXPIRATION:
-        delay = TOO_MANY_API_CALLS_DELAY
-        headers = {'Content-type' : 'application/json' }
-        while True:
-            api_call_throttle.wait()
-            response = requests.get(url, headers=headers)
-            if response.status_code == requests.codes.too_many:
-                time.sleep(delay)
-                delay *= 2
-            else:
-                break
-        if response.status_code == requests.codes.ok:
-            cache[url] = (tim, response.json())
+    return api_get(url)
+
+# Returns a dictionary that maps ids to taxa. The ids are looked up in the
+# cache first, the others are requested in chunks of up to API_MAX_IDS ids
+# per call; up to API_MAX_WORKERS calls run concurrently. Each taxon is
+# cached individually as if requested by get_taxa_by_id.
+def get_taxa_by_ids(ids):
+    taxa = {}
+    missing = []
+    for id in dict.fromkeys(ids):
+        response = cache.get(cache_key(API_HOST + f'/taxa/{id}'))
+        if response and response.get('results'):
+            taxa[id] = response['results'][0]
         else:
-            print(response.text)
-            return None
-    return cache[url][1]
+            missing.append(id)
+
+    def request_chunk(chunk):
+        response = api_request(API_HOST + '/taxa/' +
+                               '%2C'.join([str(i) for i in chunk]))
+        if not response or 'results' not in response:
+            return []
+        results = [taxon for taxon in response['results']
+                   if taxon['id'] in chunk]
+        for taxon in results:
+            cache.put(cache_key(API_HOST + f"/taxa/{taxon['id']}"),
+                      { 'total_results' : 1, 'page' : 1, 'per_page' : 1,
+                        'results' : [taxon] })
+        return results
+
+    chunks = [missing[first:first+API_MAX_IDS]
+              for first in range(0, len(missing), API_MAX_IDS)]
+    with concurrent.futures.ThreadPoolExecutor(API_MAX_WORKERS) as executor:
+        for results in executor.map(request_chunk, chunks):
+            for taxon in results:
+                taxa[taxon['id']] = taxon
+    return taxa
+
+# parameters to search for a taxon by current or former scientific name
+def name_query(name):
+    return { 'q' : name, 'all_names' : 'true', 'per_page' : 200 }
 
 # returns taxa by name
 def get_taxa(params):
@@ -84,25 +235,35 @@ def get_taxa(params):
     for key, val in params.items():
         if type(val) == bool:
             params[key] = 'true' if val else 'false'
-    key = pickle.dumps((url, params)).hex()
-    tim = time.time()
-    if not key in cache or cache[key][0] < tim - CACHE_EXPIRATION:
-        delay = TOO_MANY_API_CALLS_DELAY
-        headers = {'Content-type' : 'application/json' }
-        while True:
-            api_call_throttle.wait()
-            response = requests.get(url, headers=headers, params=params)
-            if response.status_code == requests.codes.too_many:
-                time.sleep(delay)
-                delay *= 2
-            else:
-                break
-        if response.status_code == requests.codes.ok:
-            cache[key] = (tim, response.json())
-        else:
-            print(response.text)
-            return None
-    return cache[key][1]
+    return api_get(url, params)
+
+# Collects taxon ids and names that need to be looked up and resolves them
+# together: ids in chunks with get_taxa_by_ids, names with one search each.
+# Up to API_MAX_WORKERS searches run concurrently within the rate limit.
+# The responses are cached; afterwards, get_taxa_by_id and get_taxa with
+# name_query are served from the cache.
+class TaxaResolver:
+
+    def __init__(self):
+        self.ids = []
+        self.names = []
+
+    def add_id(self, id):
+        self.ids.append(id)
+
+    def add_name(self, name):
+        self.names.append(name)
+
+    # Returns a dictionary that maps ids to taxa.
+    def resolve(self):
+        taxa = get_taxa_by_ids(self.ids)
+        with concurrent.futures.ThreadPoolExecutor(API_MAX_WORKERS) as executor:
+            for _ in executor.map(lambda name: get_taxa(name_query(name)),
+                                  dict.fromkeys(self.names)):
+                pass
+        self.ids = []
+        self.names = []
+        return taxa
 
 
 if __name__ == '__main__':
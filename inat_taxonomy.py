@@ -1,7 +1,6 @@
-import csv, sys, os, time, locale, zipfile, io
+import csv, sys, os, time, locale, zipfile, io, sqlite3, json, hashlib
 import inat_api
 from dataclasses import dataclass
-from typing import List, Dict
 
 # The directory where this Python script is located.
 INSTALL_DIR = os.path.dirname(__file__)
@@ -83,78 +82,174 @@ class Taxon:
     name      : str
     rank_level: float
 
-# iNaturalist taxa, only loaded when a taxonomic tree needs
-# to be computed from a label file.
+# iNaturalist taxa, only loaded when a taxonomic tree needs to be computed
+# from a label file. The taxa are imported from the zip archive once into an
+# indexed SQLite database next to it; lookups query this database.
 
-gName2Taxa: Dict[str,List[Taxon]] = {}
-"maps taxon name to list of taxa"
+INAT_TAXONOMY_DB = os.path.splitext(INAT_TAXONOMY)[0] + '.sqlite'
 
-gId2Taxon: Dict[int,Taxon]        = {}
-"maps taxon id to taxon"
+TAXA_DB_VERSION = 1 # increment when the database schema changes
 
-def load_inat_taxonomy():
-    "Load all iNaturalist taxa from file 'taxa.csv'."
-    global gName2Taxa
-    global gId2Taxon
+gTaxaDb: sqlite3.Connection = None
+"connection to database of iNaturalist taxa"
 
-    if gName2Taxa and gId2Taxon:
-        return True # already loaded
+gId2Taxon = {}
+"taxa looked up in the database by id"
+
+gLineages = {}
+"maps taxon ids to their lineages, tuples of Taxon from the kingdom down"
+
+def archive_signature():
+    "Modification time and size of the zip archive, invalidate database."
+    stat = os.stat(INAT_TAXONOMY)
+    return f'{TAXA_DB_VERSION}:{stat.st_mtime_ns}:{stat.st_size}'
 
-    print('Loading iNaturalist taxonomy...')
+def import_inat_taxonomy(db_filename):
+    "Import all iNaturalist taxa from file 'taxa.csv' into a new database."
+    print(f"Importing iNaturalist taxonomy into '{db_filename}'...")
     start_time = time.time()
-    gName2Taxa = {}
-    gId2Taxon = {}
+    signature = archive_signature()
+    tmp_filename = f'{db_filename}.{os.getpid()}.tmp'
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
 
+    db = sqlite3.connect(tmp_filename)
     try:
+        db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        db.execute('CREATE TABLE ranks (name TEXT PRIMARY KEY, '
+                   'rank_level NUMERIC)')
+        db.execute('CREATE TABLE taxa (id INTEGER PRIMARY KEY, '
+                   'parent_id INTEGER, name TEXT, rank_level NUMERIC)')
+        db.execute('CREATE TEMPORARY TABLE pending (id INTEGER, rank TEXT)')
+
+        num_taxa = 0
+        new_ranks = {} # maps ranks not in gName2RankLevel to a taxon id
+        def rows(reader):
+            nonlocal num_taxa
+            for row in reader:
+                id = int(row['id'])
+                parent_id = row['parentNameUsageID'].split('/')[-1]
+                parent_id = int(parent_id) if parent_id else \
+                         ROOT_TAXON_ID if id != ROOT_TAXON_ID else None
+                name = row['scientificName']
+                rank = row['taxonRank']
+                if not rank in gName2RankLevel:
+                    # resolved after import, rows are updated then
+                    if not rank in new_ranks:
+                        new_ranks[rank] = id
+                    db.execute('INSERT INTO pending VALUES (?, ?)', (id, rank))
+                    rank_level = None
+                else:
+                    rank_level = gName2RankLevel[rank]
+                num_taxa += 1
+                if num_taxa % 10000 == 0:
+                    print(f' {num_taxa:,} ' if num_taxa % 100000 == 0
+                          else '.', end='')
+                    sys.stdout.flush()
+                yield id, parent_id, name, rank_level
+
         with zipfile.ZipFile(INAT_TAXONOMY, 'r') as zf:
             with zf.open('taxa.csv', 'r') as zfile:
                 with io.TextIOWrapper(zfile, encoding = 'latin-1') as csvfile:
-                    reader = csv.DictReader(csvfile)
-                    for row in reader:
-                        id = int(row['id'])
-                        parent_id = row['parentNameUsageID'].split('/')[-1]
-                        parent_id = int(parent_id) if parent_id else \
-                                 ROOT_TAXON_ID if id != ROOT_TAXON_ID else None
-                        name = row['scientificName']
-                        rank = row['taxonRank']
-                        if not rank in gName2RankLevel:
-                            response = inat_api.get_taxa_by_id(id)
-                            if response and 'results' in response:
-                                rank_level = response['results'][0]\
-                                                     ['rank_level']
-                                gName2RankLevel[rank] = rank_level
-                                if not rank_level in gRankLevel2Name:
-                                    gRankLevel2Name[rank_level] = rank
-                                print(f"Please add rank '{rank}' to gName2Rank"
-                                      f"Level, numeric value {rank_level}.")
-                            else:
-                                gName2RankLevel[rank] = -1
-                        rank_level = gName2RankLevel[rank]
-                        inat_taxon = Taxon(id, parent_id, name, rank_level)
-                        if name in gName2Taxa:
-                            gName2Taxa[name].append(inat_taxon)
-                        else:
-                            gName2Taxa[name] = [inat_taxon]
-                        assert not id in gId2Taxon
-                        gId2Taxon[id] = inat_taxon
-                        if len(gId2Taxon) % 10000 == 0:
-                            print(f' {len(gId2Taxon):,} ' if len(gId2Taxon) %
-                                  100000 == 0 else '.', end='')
-                            sys.stdout.flush()
-
-        assert ROOT_TAXON_ID in gId2Taxon
-        print(f' {len(gId2Taxon):,}.')
-        print(f'Loaded iNaturalist taxonomy of {len(gId2Taxon):,} taxa '
-              f'in {time.time()-start_time:.1f} secs.')
+                    db.executemany('INSERT INTO taxa VALUES (?, ?, ?, ?)',
+                                   rows(csv.DictReader(csvfile)))
+
+        # look up the numeric values of new ranks with few API calls
+        resolver = inat_api.TaxaResolver()
+        for id in new_ranks.values():
+            resolver.add_id(id)
+        taxa = resolver.resolve()
+        for rank, id in new_ranks.items():
+            if id in taxa:
+                rank_level = taxa[id]['rank_level']
+                gName2RankLevel[rank] = rank_level
+                if not rank_level in gRankLevel2Name:
+                    gRankLevel2Name[rank_level] = rank
+                print(f"Please add rank '{rank}' to gName2Rank"
+                      f"Level, numeric value {rank_level}.")
+            else:
+                gName2RankLevel[rank] = -1
+            db.execute('INSERT INTO ranks VALUES (?, ?)',
+                       (rank, gName2RankLevel[rank]))
+            db.execute('UPDATE taxa SET rank_level = ? WHERE id IN '
+                       '(SELECT id FROM pending WHERE rank = ?)',
+                       (gName2RankLevel[rank], rank))
+        db.execute('DROP TABLE pending')
+        db.execute('CREATE INDEX taxa_name ON taxa (name)')
+        assert db.execute('SELECT 1 FROM taxa WHERE id = ?',
+                          (ROOT_TAXON_ID,)).fetchone()
+        db.execute("INSERT INTO meta VALUES ('archive', ?)", (signature,))
+        db.commit()
+        db.close()
+        os.replace(tmp_filename, db_filename)
+    except:
+        db.close()
+        os.remove(tmp_filename)
+        raise
+
+    print(f' {num_taxa:,}.')
+    print(f'Imported iNaturalist taxonomy of {num_taxa:,} taxa '
+          f'in {time.time()-start_time:.1f} secs.')
+
+def open_inat_taxonomy(db_filename):
+    """
+    Open database of iNaturalist taxa, returns None if it does not exist or
+    is out of date.
+    """
+    if not os.path.isfile(db_filename):
+        return None
+    db = sqlite3.connect(db_filename, check_same_thread=False)
+    try:
+        row = db.execute("SELECT value FROM meta WHERE key = 'archive'").\
+                 fetchone()
+        if row and row[0] == archive_signature():
+            return db
+    except sqlite3.Error:
+        pass
+    db.close()
+    return None
+
+def load_inat_taxonomy():
+    "Open iNaturalist taxa, import them from 'taxa.csv' first if needed."
+    global gTaxaDb
+
+    if gTaxaDb:
+        return True # already loaded
+
+    try:
+        db = open_inat_taxonomy(INAT_TAXONOMY_DB)
+        if not db:
+            import_inat_taxonomy(INAT_TAXONOMY_DB)
+            db = open_inat_taxonomy(INAT_TAXONOMY_DB)
+        for rank, rank_level in db.execute('SELECT name, rank_level '
+                                           'FROM ranks'):
+            gName2RankLevel[rank] = rank_level
+            if not rank_level in gRankLevel2Name:
+                gRankLevel2Name[rank_level] = rank
+        gTaxaDb = db
         return True
 
     except Exception as e:
         print("Cannot load taxonomy 'taxa.csv' from archive "
               f"'{INAT_TAXONOMY}': {str(e)}.")
-        gName2Taxa = {}
-        gId2Taxon = {}
+        gTaxaDb = None
         return False
 
+def get_taxon(id):
+    "Returns the taxon for an id or None."
+    if id in gId2Taxon:
+        return gId2Taxon[id]
+    row = gTaxaDb.execute('SELECT id, parent_id, name, rank_level FROM taxa '
+                          'WHERE id = ?', (id,)).fetchone()
+    taxon = gId2Taxon[id] = Taxon(*row) if row else None
+    return taxon
+
+def get_taxa_by_name(name):
+    "Returns the list of taxa with this name."
+    return [Taxon(*row) for row in
+            gTaxaDb.execute('SELECT id, parent_id, name, rank_level FROM taxa '
+                            'WHERE name = ? ORDER BY rowid', (name,))]
+
 def beautify_common_name(name):
     "Capitalize (most) words in common name; helper function for common names."
     if name.endswith(' [paraphyletic]'):
@@ -165,95 +260,220 @@ def beautify_common_name(name):
                     else word[0].upper() + word[1:]
                     for word in name.split())
 
-def annotate_common_names(id2taxon, all_common_names = False):
-    """
-    Load the common names in our language, annotate taxonomic tree with them.
-    The parameter `id2taxon' includes the taxa we are interested in.
-    """
-    start_time = time.time()
+def get_language():
+    "Our language for common names."
     language, _ = locale.getdefaultlocale()
 
     if language in ['C', 'C.UTF-8', 'POSIX']:
         language = 'en'
+    return language
+
+def read_common_names(language, taxon_ids):
+    """
+    Read the common names in our language for the taxa in `taxon_ids' from
+    the zip archive. Returns a dictionary that maps taxon ids to lists of
+    common names, the preferred name first, and the total number of names
+    read. Returns None on failure.
+    """
+    with zipfile.ZipFile(INAT_TAXONOMY, 'r') as zf:
+        perfect_match = []
+        other_matches = []
+
+        # check all common names files for names in our language
+        for fname in zf.namelist():
+            if fname.startswith("VernacularNames-") and \
+               fname.endswith(".csv"):
+                with zf.open(fname, 'r') as zfile:
+                    with io.TextIOWrapper(zfile, encoding='utf-8') as csvf:
+                        reader = csv.DictReader(csvf)
+                        for row in reader:
+                            lang = row['language']
+                            if lang == language:
+                                perfect_match.append(fname)  # en vs en
+                            elif len(lang) < len(language) and \
+                                 lang == language[:len(lang)]:
+                                other_matches.append(fname)  # en vs en_US
+                            break
+
+        if not perfect_match and not other_matches:
+            print("Cannot find common names for language '{language}'.")
+            return None
+
+        # collect the common names of our taxa
+        total_names = 0
+        common_names = {}
+        for fname in perfect_match + other_matches:
+            print(f"Reading common names from '{INAT_TAXONOMY}' "
+                  f"member '{fname}'...")
+            with zf.open(fname, 'r') as zfile:
+                with io.TextIOWrapper(zfile, encoding='utf-8') as csvf:
+                    reader = csv.DictReader(csvf)
+                    for row in reader:
+                        total_names += 1
+                        id = int(row['id'])
+                        if id in taxon_ids:
+                            cname = beautify_common_name(row['vernacularName'])
+                            if id in common_names:
+                                common_names[id].append(cname)
+                            else:
+                                common_names[id] = [cname]
+    return common_names, total_names
+
+def taxa_hash(taxon_ids):
+    "Hash of a set of taxon ids, identifies the taxa of a model."
+    ids = ','.join(str(id) for id in sorted(taxon_ids))
+    return hashlib.sha1(ids.encode('ascii')).hexdigest()
+
+def read_common_names_cache(cache_filename, language, taxon_ids):
+    """
+    Read common names from a cache file written by write_common_names_cache.
+    Returns None if the cache does not exist or is out of date.
+    """
+    if not os.path.isfile(cache_filename):
+        return None
+    try:
+        with open(cache_filename, encoding='utf-8') as f:
+            cache = json.load(f)
+        if cache['archive'] != archive_signature() or \
+           cache['language'] != language or \
+           cache['taxa'] != taxa_hash(taxon_ids):
+            return None
+        return { int(id) : names for id, names in cache['names'].items() }
+    except Exception as e:
+        print(f"Cannot read common names from '{cache_filename}': {str(e)}.")
+        return None
+
+def write_common_names_cache(cache_filename, language, taxon_ids,
+                             common_names):
+    "Write common names of a model's taxa in our language to a cache file."
+    tmp_filename = f'{cache_filename}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            json.dump({ 'archive'  : archive_signature(),
+                        'language' : language,
+                        'taxa'     : taxa_hash(taxon_ids),
+                        'names'    : common_names }, f, ensure_ascii=False)
+        os.replace(tmp_filename, cache_filename)
+    except Exception as e:
+        print(f"Failure writing common names to '{cache_filename}':", str(e))
+        try:
+            os.remove(tmp_filename)
+        except Exception:
+            pass
+
+def get_common_names(taxon_ids, all_common_names = False,
+                     cache_prefix = None):
+    """
+    Load the common names in our language for the taxa in `taxon_ids', a set
+    of the taxon ids of the taxonomic tree including its root. Returns a
+    dictionary that maps taxon ids to common names; with `all_common_names',
+    the names of a taxon are separated by semicolons. Returns None on
+    failure. With `cache_prefix', the common names of these taxa are cached
+    in file `<cache_prefix>.common_names.<language>.json'; later calls read
+    this file instead of the zip archive until the archive changes.
+    """
+    start_time = time.time()
+    language = get_language()
 
     if not os.path.isfile(INAT_TAXONOMY):
         print("Cannot load common names, archive "
               f"'{INAT_TAXONOMY}' does not exist.")
-        return
+        return None
 
     try:
-        with zipfile.ZipFile(INAT_TAXONOMY, 'r') as zf:
-            perfect_match = []
-            other_matches = []
-
-            # check all common names files for names in our language
-            for fname in zf.namelist():
-                if fname.startswith("VernacularNames-") and \
-                   fname.endswith(".csv"):
-                    with zf.open(fname, 'r') as zfile:
-                        with io.TextIOWrapper(zfile, encoding='utf-8') as csvf:
-                            reader = csv.DictReader(csvf)
-                            for row in reader:
-                                lang = row['language']
-                                if lang == language:
-                                    perfect_match.append(fname)  # en vs en
-                                elif len(lang) < len(language) and \
-                                     lang == language[:len(lang)]:
-                                    other_matches.append(fname)  # en vs en_US
-                                break
-
-            if not perfect_match and not other_matches:
-                print("Cannot find common names for language '{language}'.")
-                return
-
-            # annotate the taxa with common names
-            total_names = loaded_names = 0
-            for fname in perfect_match + other_matches:
-                print(f"Reading common names from '{INAT_TAXONOMY}' "
-                      f"member '{fname}'...")
-                with zf.open(fname, 'r') as zfile:
-                    with io.TextIOWrapper(zfile, encoding='utf-8') as csvf:
-                        reader = csv.DictReader(csvf)
-                        for row in reader:
-                            total_names += 1
-                            id = int(row['id'])
-                            if id in id2taxon and (all_common_names or \
-                                            id2taxon[id].common_name is None):
-                                loaded_names += 1
-                                cname = beautify_common_name(row['vernacular'
-                                                                 'Name'])
-                                if id2taxon[id].common_name is None:
-                                    id2taxon[id].common_name = cname
-                                else:
-                                    id2taxon[id].common_name += '; ' + cname
-
-        print(f'Read {total_names:,} common names in '
+        common_names = None
+        if cache_prefix:
+            cache_filename = f'{cache_prefix}.common_names.{language}.json'
+            common_names = read_common_names_cache(cache_filename, language,
+                                                   taxon_ids)
+        if common_names is None:
+            result = read_common_names(language, taxon_ids)
+            if result is None:
+                return None
+            common_names, total_names = result
+            if cache_prefix:
+                write_common_names_cache(cache_filename, language, taxon_ids,
+                                         common_names)
+            source = f'{total_names:,} common names'
+        else:
+            source = f"common names from '{cache_filename}'"
+
+        # one or all common names of each taxon
+        loaded_names = 0
+        id2name = {}
+        for id, names in common_names.items():
+            if not all_common_names:
+                names = names[:1]
+            loaded_names += len(names)
+            id2name[id] = '; '.join(names)
+
+        print(f'Read {source} in '
               f'{time.time()-start_time:.1f} secs, loaded {loaded_names:,} '
-              f'in language "{language}" for {len(id2taxon)-1:,} taxa.')
+              f'in language "{language}" for {len(taxon_ids)-1:,} taxa.')
+        return id2name
 
     except Exception as e:
         print(f"Cannot load common names from archive '{INAT_TAXONOMY}':"
               f" {str(e)}.")
+        return None
+
+def get_lineage(id):
+    """
+    Returns the lineage of a taxon, a tuple of instances of Taxon from the
+    kingdom down to the taxon with this id. Lineages are memoized; the walk
+    up the tree stops at the first taxon with a known lineage, hence each
+    taxon is looked up only once.
+    """
+    path = [] # taxa without known lineage, from the bottom up
+    while id not in gLineages:
+        taxon = get_taxon(id)
+        if taxon is None:
+            lineage = () # broken lineage, should not happen
+            break
+        path.append(taxon)
+        if taxon.rank_level >= KINGDOM_RANK_LEVEL:
+            lineage = ()
+            break
+        id = taxon.parent_id
+    else:
+        lineage = gLineages[id]
+
+    for taxon in reversed(path):
+        lineage += (taxon,)
+        gLineages[taxon.id] = lineage
+    return lineage
 
 def get_ancestors(id, ancestors):
     """
     Ancestors are a list of instances of Taxon; they are ordered from the
-    kingdom down.
+    kingdom down to the taxon with this id.
+    """
+    ancestors.extend(get_lineage(id))
+
+def prefetch_names(names):
+    """
+    Names not found in the iNaturalist taxonomy are looked up with API calls
+    by lookup_id. Look them up in bulk beforehand, later calls of lookup_id
+    are then served from the cache of API responses.
     """
-    taxon = gId2Taxon[id]
-    if taxon.rank_level < KINGDOM_RANK_LEVEL:
-        get_ancestors(taxon.parent_id, ancestors)
-    ancestors.append(taxon)
+    if not gTaxaDb:
+        return # taxonomy not loaded
+    resolver = inat_api.TaxaResolver()
+    for name in names:
+        if not get_taxa_by_name(name):
+            resolver.add_name(name)
+    resolver.resolve()
 
 def lookup_id(name, desired_ranks = ['species', 'subspecies']):
     """
-    Lookup by name, returns a pair, a Taxon and its ancestors, a list of
-    Taxon. Desired_ranks are returned in case of ambiguities (duplicate names).
+    Lookup by name, returns a pair, a Taxon and its ancestors, a tuple of
+    Taxon from the kingdom down. Desired_ranks are returned in case of
+    ambiguities (duplicate names).
     """
-    if not gName2Taxa:
+    if not gTaxaDb:
         return None # taxonomy not loaded
-    if name in gName2Taxa:
-        taxa = gName2Taxa[name]
+    taxa = get_taxa_by_name(name)
+    if taxa:
         if len(taxa) > 1:
             species = None
             subspecies = None
@@ -272,15 +492,13 @@ def lookup_id(name, desired_ranks = ['species', 'subspecies']):
             print(f"; choosing {rank}.")
         else:
             taxon = taxa[0]
-        ancestors = []
+        ancestors = ()
         if taxon.rank_level < KINGDOM_RANK_LEVEL:
-            get_ancestors(taxon.parent_id, ancestors)
+            ancestors = get_lineage(taxon.parent_id)
         return (taxon, ancestors)
     else:
         # likely taxon change, query iNat API
-        response = inat_api.get_taxa({ 'q'         : name,
-                                       'all_names' : 'true',
-                                       'per_page'  : 200 })
+        response = inat_api.get_taxa(inat_api.name_query(name))
         if not response:
             print(f"API lookup for name '{name}' failed.")
             return
@@ -292,7 +510,7 @@ def lookup_id(name, desired_ranks = ['species', 'subspecies']):
             if exact_matches:
                 taxa = exact_matches
         ids = [taxon['id'] for taxon in taxa]
-        taxa = set([gId2Taxon[id] for id in ids if id in gId2Taxon])
+        taxa = set([taxon for taxon in map(get_taxon, ids) if taxon])
         if not taxa:
             return
         while len(taxa) > 1:
@@ -300,16 +518,16 @@ def lookup_id(name, desired_ranks = ['species', 'subspecies']):
             min_rank_level = min([taxon.rank_level for taxon in taxa])
             new_taxa = set()
             for taxon in taxa:
-                new_taxon = gId2Taxon[taxon.parent_id] \
+                new_taxon = get_taxon(taxon.parent_id) \
                               if taxon.rank_level == min_rank_level \
                               else taxon
                 if not new_taxon in new_taxa:
                     new_taxa.add(new_taxon)
             taxa = new_taxa
         taxon = taxa.pop()
-        ancestors = []
+        ancestors = ()
         if taxon.rank_level < KINGDOM_RANK_LEVEL:
-            get_ancestors(taxon.parent_id, ancestors)
+            ancestors = get_lineage(taxon.parent_id)
         return (taxon, ancestors)
 
 
@@ -2,21 +2,32 @@
 
 import numpy as np
 from PIL import Image, ImageOps
-import csv, sys, os, time
-import inat_taxonomy
+import csv, sys, os, time, collections, concurrent.futures, hashlib
+import http.server, io, json, queue, threading
+import contextlib, heapq, math, multiprocessing, sqlite3
+import inat_taxonomy, sqlite_cache
 
-try:
-    # try importing TensorFlow Lite first
-    import tflite_runtime.interpreter as tflite
-except Exception:
-    try:
-        # TensorFlow Lite not found, try to import full TensorFlow
-        import tensorflow.lite as tflite
-    except Exception:
-        print('Error: TensorFlow Lite could not be loaded.', file=sys.stderr)
-        print('       Follow instructions at https://www.tensorflow.org/lite/'
-              'guide/python to install it.', file=sys.stderr)
-        sys.exit(1)
+# TensorFlow Lite is imported on first use.
+tflite = None
+
+def import_tflite():
+    global tflite
+    if tflite is None:
+        try:
+            # try importing TensorFlow Lite first
+            import tflite_runtime.interpreter as tflite_module
+        except Exception:
+            try:
+                # TensorFlow Lite not found, try to import full TensorFlow
+                import tensorflow.lite as tflite_module
+            except Exception:
+                print('Error: TensorFlow Lite could not be loaded.',
+                      file=sys.stderr)
+                print('       Follow instructions at https://www.tensorflow.'
+                      'org/lite/guide/python to install it.', file=sys.stderr)
+                sys.exit(1)
+        tflite = tflite_module
+    return tflite
 
 # The directory where this Python script is located.
 INSTALL_DIR = inat_taxonomy.INSTALL_DIR
@@ -24,27 +35,53 @@ INSTALL_DIR = inat_taxonomy.INSTALL_DIR
 # This directory contains models, label files, and taxonomy files.
 CLASSIFIER_DIRECTORY = os.path.join(INSTALL_DIR, 'classifiers')
 
+# This directory holds the cache of classification results.
+if sys.platform == 'win32':
+    CACHE_DIR = os.path.join(os.path.expanduser('~'),
+                             'AppData', 'Local', 'nature_id')
+else:
+    CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'nature_id')
+
+RESULT_CACHE_MAX_SIZE = 256 * 1024 ** 2 # evict results beyond 256 MB
+
+# Files with these extensions are classified when a directory is given.
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+
 # These flags can be modified with command-line options.
 scientific_names_only = False # only scientific names or also common names
 label_scores_only     = False # scores for labels or hierarchical
 all_common_names      = False # show only one or all common names
 result_sz             = 5     # result size (for label_scores_only)
-
-# This class is used by class Taxonomy.
+top_k                 = 1     # number of hierarchical paths
+batch_size            = 1     # number of images per interpreter call
+loader_threads        = 0     # threads loading images, 0 for main thread
+queue_depth           = 16    # max number of images loaded ahead
+full_decode           = False # decode JPEG images at full resolution
+pool_size             = 1     # number of interpreters classifying concurrently
+num_threads           = None  # threads per interpreter, None for default
+workers               = 1     # number of worker processes
+cache_results         = False # cache scores of classified images
+output_format         = 'text'# format of results: text, jsonl, or csv
+within                = None  # taxon id or name to restrict predictions to
+
+# A view of the taxon with index `idx' in a Taxonomy. Views are only created
+# for the taxa in results; the taxonomy itself is stored in arrays.
 class Taxon:
 
-    def __init__(self, taxon_id):
-        self.taxon_id = taxon_id  # for internal lookups and iNat API calls
-        self.rank_level = None    # taxonomic rank, e.g. species, genus, family
-        self.name = None          # scientific name
-        self.common_name = None   # common name or None
-        self.children = []        # list of child taxa
-        self.leaf_class_ids = []  # list of indices into scores; there
-                                  # can be more than one when we use old models
-                                  # whose taxa have since been lumped together
-
-    def add_child(self, child_taxon):
-        self.children.append(child_taxon)
+    __slots__ = ['taxon_id', 'rank_level', 'name', 'common_name']
+
+    def __init__(self, taxonomy, idx):
+        self.taxon_id = int(taxonomy.taxon_ids[idx])  # for iNat API calls
+        rank_level = float(taxonomy.rank_levels[idx]) # e.g. species, genus
+        self.rank_level = int(rank_level) if rank_level.is_integer() \
+                          else rank_level
+        self.name = taxonomy.get_string(taxonomy.names, taxonomy.name_offsets,
+                                        idx) # scientific name
+        self.common_name = None              # common name or None
+        if taxonomy.common_names is not None:
+            self.common_name = taxonomy.get_string(
+                                 taxonomy.common_names,
+                                 taxonomy.common_name_offsets, idx) or None
 
     # get taxonomic rank as a string
     def get_rank(self):
@@ -61,30 +98,55 @@ class Taxon:
             return self.name
 
 
-# This taxonomy is represented in terms of instances of class Taxon.
+# The taxonomy is stored as a struct of arrays indexed in pre-order, the root
+# has index 0: taxon ids, rank levels, parent indices, and depths, the
+# children in compressed sparse row format, the leaf class ids of each taxon,
+# and the scientific and common names packed into UTF-8 byte strings with an
+# array of offsets each. Scores can be propagated up the hierarchy with a few
+# vectorized operations, and a large taxonomy takes little memory and no
+# Python objects per taxon.
 class Taxonomy:
 
+    SNAPSHOT_VERSION = 1 # increment when the snapshot format changes
+
     def __init__(self):
-        # The taxonomy file may contain multiple trees, one for each kingdom.
-        # In order to have a single tree for prediction, we add a node for
-        # Life as the parent of all kingdoms. This will be the root of our tree.
-        self.root = Taxon(inat_taxonomy.ROOT_TAXON_ID)
-        self.root.name = inat_taxonomy.ROOT_NAME
-        self.root.rank_level = inat_taxonomy.ROOT_RANK_LEVEL
-        self.id2taxon = { self.root.taxon_id : self.root }
-        self.idx2label = {}
+        self.reset()
 
     def reset(self):
-        self.root.children = []
-        self.id2taxon = { self.root.taxon_id : self.root }
-        self.idx2label = {}
+        self.taxon_ids = None           # taxon ids in pre-order
+        self.idx2label = {}             # labels of a label file
+        self.label_taxon_indices = None # taxon index for each label
+        self.common_names = None        # packed common names, if loaded
+        self.clade_idx = 0              # index of the taxon predictions are
+                                        # restricted to, 0 for the root
 
     def taxonomy_available(self):
-        return len(self.root.children) > 0
+        return self.taxon_ids is not None and len(self.taxon_ids) > 1
+
+    # Number of labels, the leaf classes of the model.
+    def num_labels(self):
+        if self.taxonomy_available():
+            return len(self.leaf_class_ids)
+        return len(self.idx2label)
 
     def read_taxonomy(self, filename):
         start_time = time.time()
         self.reset()
+        if self.read_snapshot(filename):
+            print(f"Read taxonomy from '{self.snapshot_filename(filename)}' "
+                  f"in {time.time() - start_time:.1f} secs: "
+                  f"{len(self.taxon_ids) - 1:,} taxa including "
+                  f"{self.num_labels():,} leaf taxa.")
+        else:
+            self.parse_taxonomy(filename)
+
+        if not scientific_names_only and self.taxonomy_available():
+            self.annotate_common_names(os.path.splitext(filename)[0])
+
+    # Read label file or taxonomy file.
+    def parse_taxonomy(self, filename):
+        start_time = time.time()
+        taxa = {} # taxon id -> [parent id, rank level, leaf class ids, name]
         with open(filename, newline='', encoding='latin-1') as csvfile:
             reader = csv.DictReader(csvfile)
             for row in reader:
@@ -92,79 +154,100 @@ class Taxonomy:
                     self.idx2label[int(row['id'])] = row['name']
                     continue
 
-                taxon_id = int(row['taxon_id'])
-                if taxon_id in self.id2taxon:
-                    taxon = self.id2taxon[taxon_id] # inserted earlier as parent
-                else:
-                    self.id2taxon[taxon_id] = taxon = Taxon(taxon_id)
-
-                taxon.name = row['name']
                 if row['rank_level'].isdigit():
-                    taxon.rank_level = int(row['rank_level'])
+                    rank_level = int(row['rank_level'])
                 else:
-                    taxon.rank_level = float(row['rank_level'])
+                    rank_level = float(row['rank_level'])
 
+                leaf_class_ids = []
                 if len(row['leaf_class_id']):
-                    for leaf_class_id in row['leaf_class_id'].split(';'):
-                        leaf_class_id = int(leaf_class_id)
-                        taxon.leaf_class_ids.append(leaf_class_id)
-                        self.idx2label[leaf_class_id] = taxon.name
+                    leaf_class_ids = [int(leaf_class_id) for leaf_class_id
+                                      in row['leaf_class_id'].split(';')]
 
+                parent_taxon_id = None # root
                 if len(row['parent_taxon_id']):
                     parent_taxon_id = int(row['parent_taxon_id'])
-                else:
-                    parent_taxon_id = self.root.taxon_id
-                if not parent_taxon_id in self.id2taxon:
-                    self.id2taxon[parent_taxon_id] = Taxon(parent_taxon_id)
 
-                self.id2taxon[parent_taxon_id].add_child(taxon)
+                taxa[int(row['taxon_id'])] = [parent_taxon_id, rank_level,
+                                              leaf_class_ids, row['name']]
 
-        if not self.taxonomy_available():
+        if not taxa:
             # We parsed a label file; unless told otherwise, we use these
             # labels to build a taxonomic tree.
             print(f"Read {len(self.idx2label):,} labels from '{filename}' "
                   f"in {time.time() - start_time:.1f} secs.")
 
             if not label_scores_only:
-                self.compute_taxonomic_tree()
-                if self.taxonomy_available():
+                taxa = self.compute_taxonomic_tree()
+                if taxa:
+                    self.compile_tree(taxa)
+                    self.idx2label = {} # labels are taxa now
                     self.write_taxonomic_tree(filename.replace('labelmap',
                                                                'taxonomy'))
         else:
+            self.compile_tree(taxa)
             print(f"Read taxonomy from '{filename}' in "
                   f"{time.time() - start_time:.1f} secs: "
-                  f"{len(self.id2taxon) - 1:,} taxa including "
-                  f"{len(self.idx2label):,} leaf taxa.")
-
-        if not scientific_names_only and self.taxonomy_available():
-            inat_taxonomy.annotate_common_names(self.id2taxon, all_common_names)
-            if label_scores_only:
-                self.annotate_labels_with_common_names()
-        del self.id2taxon # not needed anymore
-
-    # augment labels with common names
-    def annotate_labels_with_common_names(self):
-        for taxon in self.id2taxon.values():
-            for leaf_class_id in taxon.leaf_class_ids:
-                self.idx2label[leaf_class_id] = taxon.get_name()
-
-    # write one row to taxonomy file
-    def write_row(self, writer, taxon, parent_taxon_id):
-        writer.writerow([parent_taxon_id, taxon.taxon_id, taxon.rank_level,
-                         ';'.join([str(id) for id in taxon.leaf_class_ids]),
-                         taxon.name])
-        for child in taxon.children:
-            self.write_row(writer, child, taxon.taxon_id)
+                  f"{len(self.taxon_ids) - 1:,} taxa including "
+                  f"{self.num_labels():,} leaf taxa.")
+            self.write_snapshot(filename)
+
+    # Look up the common names of all taxa and pack them like the names.
+    def annotate_common_names(self, cache_prefix):
+        common_names = inat_taxonomy.get_common_names(
+                         set(self.taxon_ids.tolist()), all_common_names,
+                         cache_prefix)
+        if not common_names:
+            return
+        id2idx = { taxon_id : idx
+                   for idx, taxon_id in enumerate(self.taxon_ids.tolist()) }
+        names = [''] * len(self.taxon_ids)
+        for taxon_id, name in common_names.items():
+            names[id2idx[taxon_id]] = name
+        self.common_names, self.common_name_offsets = self.pack_strings(names)
+
+    # Pack strings into UTF-8 bytes and an array of offsets.
+    @staticmethod
+    def pack_strings(strings):
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(string) for string in encoded])
+        return b''.join(encoded), offsets
+
+    @staticmethod
+    def get_string(packed, offsets, idx):
+        return packed[offsets[idx]:offsets[idx+1]].decode('utf-8')
+
+    # Returns a view of the taxon with index `idx'.
+    def get_taxon(self, idx):
+        return Taxon(self, idx)
+
+    # Returns the name of a label, with its common name if loaded.
+    def get_label(self, leaf_class_id):
+        if self.label_taxon_indices is None:
+            return self.idx2label[leaf_class_id]
+        return self.get_taxon(self.label_taxon_indices[leaf_class_id]).\
+               get_name()
 
     # write taxonomy file
     def write_taxonomic_tree(self, filename):
         try:
+            leaf_class_ids = collections.defaultdict(list)
+            for idx, leaf_class_id in zip(self.leaf_taxon_indices.tolist(),
+                                          self.leaf_class_ids.tolist()):
+                leaf_class_ids[idx].append(str(leaf_class_id))
             with open(filename, 'w', newline='', encoding='latin-1') as csvfile:
                 writer = csv.writer(csvfile)
                 writer.writerow(['parent_taxon_id', 'taxon_id', 'rank_level',
                                  'leaf_class_id', 'name'])
-                for child in self.root.children:
-                    self.write_row(writer, child, '')
+                for idx in range(1, len(self.taxon_ids)):
+                    taxon = self.get_taxon(idx)
+                    parent_idx = self.parent_indices[idx]
+                    writer.writerow([self.taxon_ids[parent_idx]
+                                     if parent_idx else '', taxon.taxon_id,
+                                     taxon.rank_level,
+                                     ';'.join(leaf_class_ids[idx]),
+                                     taxon.name])
             print(f"Taxonomy written to file '{filename}'.")
         except Exception as e:
             print(f"Failure writing taxonomy to file '{filename}':", str(e))
@@ -174,16 +257,20 @@ class Taxonomy:
                 pass
 
     # Called after loading label file for Google's AIY Vision Kit.
-    # Adds all the labels' direct and indirect ancestors to compute
-    # the taxonomic tree.
+    # Looks up all the labels' direct and indirect ancestors to compute
+    # the taxonomic tree. Returns the taxa like parse_taxonomy, None on
+    # failure.
     def compute_taxonomic_tree(self):
         global label_scores_only
         if not inat_taxonomy.load_inat_taxonomy():
             label_scores_only = True
-            return
+            return None
 
         start_time = time.time()
         new_id = 0   # id's we add on the fly for pseudo-kingdoms
+        taxa = {}    # taxon id -> [parent id, rank level, leaf class ids, name]
+
+        inat_taxonomy.prefetch_names(self.idx2label.values())
 
         for idx, name in self.idx2label.items():
             inat_taxa = inat_taxonomy.lookup_id(name)
@@ -191,12 +278,8 @@ class Taxonomy:
                 print(f"Info: Taxon for label '{name}' not found, "
                       "inserting as pseudo-kingdom.")
                 new_id -= 1
-                taxon_id = new_id
-                self.id2taxon[taxon_id] = taxon = Taxon(taxon_id)
-                taxon.rank_level = inat_taxonomy.KINGDOM_RANK_LEVEL
-                taxon.name = name
-                taxon.leaf_class_ids = [idx]
-                self.root.add_child(taxon)
+                taxa[new_id] = [None, inat_taxonomy.KINGDOM_RANK_LEVEL, [idx],
+                                name]
                 continue
 
             inat_taxon, ancestors = inat_taxa
@@ -205,172 +288,1350 @@ class Taxonomy:
                       f"'{inat_taxon.name}', iNat taxa "
                       f"id {inat_taxon.id}.")
 
-            # ancestor taxa
-            prev_ancestor = self.root
-            for ancestor in ancestors:
-                if ancestor.id in self.id2taxon:
-                    prev_ancestor = self.id2taxon[ancestor.id]
-                else:
-                    self.id2taxon[ancestor.id] = ancestor_taxon = Taxon(ancestor.id)
-                    ancestor_taxon.name = ancestor.name
-                    ancestor_taxon.rank_level = ancestor.rank_level
-                    prev_ancestor.add_child(ancestor_taxon)
-                    prev_ancestor = ancestor_taxon
+            # ancestor taxa; labels share most of their ancestors, walk up
+            # to the lowest ancestor in the tree and add the ones below it
+            first_new = len(ancestors)
+            while first_new > 0 and ancestors[first_new-1].id not in taxa:
+                first_new -= 1
+            parent_id = ancestors[first_new-1].id if first_new > 0 else None
+            for ancestor in ancestors[first_new:]:
+                taxa[ancestor.id] = [parent_id, ancestor.rank_level, [],
+                                     ancestor.name]
+                parent_id = ancestor.id
 
             # this taxon
-            if inat_taxon.id in self.id2taxon:
-                taxon = self.id2taxon[inat_taxon.id]
-                assert taxon.name == inat_taxon.name
-                assert taxon.rank_level == inat_taxon.rank_level
+            if inat_taxon.id in taxa:
+                assert taxa[inat_taxon.id][1] == inat_taxon.rank_level
+                assert taxa[inat_taxon.id][3] == inat_taxon.name
             else:
-                self.id2taxon[inat_taxon.id] = taxon = Taxon(inat_taxon.id)
-                taxon.name = inat_taxon.name
-                taxon.rank_level = inat_taxon.rank_level
-                prev_ancestor.add_child(taxon)
-            taxon.leaf_class_ids.append(idx)
+                taxa[inat_taxon.id] = [parent_id, inat_taxon.rank_level, [],
+                                       inat_taxon.name]
+            taxa[inat_taxon.id][2].append(idx)
 
         print("Computed taxonomic tree from labels in "
-              f"{time.time() - start_time:.1f} secs: {len(self.id2taxon)-1:,} "
+              f"{time.time() - start_time:.1f} secs: {len(taxa):,} "
               f"taxa including {len(self.idx2label):,} leaf taxa.")
+        return taxa
+
+    # Compile `taxa', a dictionary that maps taxon ids to lists [parent id,
+    # rank level, leaf class ids, name], into arrays indexed in pre-order.
+    # Children are ordered as in `taxa'. The taxonomy file may contain
+    # multiple trees, one for each kingdom. In order to have a single tree for
+    # prediction, we add a node for Life as the parent of all kingdoms, the
+    # taxa with parent id None or the id of Life. This will be the root of
+    # our tree.
+    def compile_tree(self, taxa):
+        ids = list(taxa)
+        id2row = { taxon_id : row for row, taxon_id in enumerate(ids) }
+        root_row = len(ids)
+        children = [[] for _ in range(len(ids) + 1)]
+        for row, taxon_id in enumerate(ids):
+            parent_id = taxa[taxon_id][0]
+            if parent_id is None or parent_id == inat_taxonomy.ROOT_TAXON_ID:
+                children[root_row].append(row)
+            elif parent_id in id2row:
+                children[id2row[parent_id]].append(row)
+
+        taxon_ids = []            # taxon ids in pre-order
+        rank_levels = []          # rank levels
+        names = []                # scientific names
+        parent_indices = []       # index of parent taxon, -1 for root
+        depths = []               # distance from root
+        leaf_taxon_indices = []   # taxon index for each leaf class id
+        leaf_class_ids = []       # leaf class ids, grouped by taxon; a taxon
+                                  # can have more than one when we use old
+                                  # models whose taxa have since been lumped
+                                  # together
+
+        stack = [(root_row, -1, 0)]
+        while stack:
+            row, parent_idx, depth = stack.pop()
+            idx = len(taxon_ids)
+            if row == root_row:
+                taxon_ids.append(inat_taxonomy.ROOT_TAXON_ID)
+                rank_levels.append(inat_taxonomy.ROOT_RANK_LEVEL)
+                names.append(inat_taxonomy.ROOT_NAME)
+            else:
+                taxon = taxa[ids[row]]
+                taxon_ids.append(ids[row])
+                rank_levels.append(taxon[1])
+                names.append(taxon[3])
+                for leaf_class_id in taxon[2]:
+                    leaf_taxon_indices.append(idx)
+                    leaf_class_ids.append(leaf_class_id)
+            parent_indices.append(parent_idx)
+            depths.append(depth)
+            for child in reversed(children[row]):
+                stack.append((child, idx, depth + 1))
+
+        self.taxon_ids = np.array(taxon_ids, dtype=np.int64)
+        self.rank_levels = np.array(rank_levels, dtype=np.float64)
+        self.names, self.name_offsets = self.pack_strings(names)
+        self.parent_indices = np.array(parent_indices, dtype=np.int32)
+        self.depths = np.array(depths, dtype=np.int32)
+        self.leaf_taxon_indices = np.array(leaf_taxon_indices, dtype=np.int32)
+        self.leaf_class_ids = np.array(leaf_class_ids, dtype=np.int32)
+        self.index_tree()
+
+    # Derive children, depth levels, and the taxa of labels from parent
+    # indices, depths, and leaf class ids.
+    def index_tree(self):
+        # children in compressed sparse row format; in pre-order, a stable
+        # sort by parent keeps the children of each taxon in order
+        parents = self.parent_indices[1:]
+        self.child_offsets = np.zeros(len(self.parent_indices) + 1,
+                                      dtype=np.int32)
+        self.child_offsets[1:] = np.cumsum(np.bincount(parents,
+                                           minlength=len(self.parent_indices)))
+        self.child_indices = (np.argsort(parents, kind='stable') + 1).\
+                             astype(np.int32)
+
+        # taxa grouped by depth, deepest first; the root is not included
+        depth_levels = [np.flatnonzero(self.depths == depth)
+                        for depth in range(self.depths.max(), 0, -1)]
+
+        # In pre-order, the subtree of each taxon is a range of indices that
+        # starts with the taxon; subtree_ends holds the end of each range.
+        sizes = np.ones(len(self.parent_indices), dtype=np.int32)
+        for level in depth_levels:
+            np.add.at(sizes, self.parent_indices[level], sizes[level])
+        self.subtree_ends = np.arange(len(sizes), dtype=np.int32) + sizes
+
+        # taxon index for each leaf class id
+        self.label_taxon_indices = np.zeros(self.leaf_class_ids.max() + 1
+                                            if len(self.leaf_class_ids)
+                                            else 0, dtype=np.int32)
+        self.label_taxon_indices[self.leaf_class_ids] = self.leaf_taxon_indices
+
+        self.set_clade(0)
+
+    # Prepare predictions for the subtree of the taxon with index `idx', the
+    # whole tree for the root. The subtree is the range of indices idx ...
+    # subtree_ends[idx]-1 and, as the leaf arrays are grouped by taxon in
+    # pre-order, its labels are a range of the leaf arrays. Predictions only
+    # look at these ranges; their arrays are indexed relative to `idx'.
+    def set_clade(self, idx):
+        end = self.subtree_ends[idx]
+        first_leaf, end_leaf = np.searchsorted(self.leaf_taxon_indices,
+                                               [idx, end])
+        self.clade_idx = idx
+        self.clade_leaf_indices = self.leaf_taxon_indices[first_leaf:
+                                                          end_leaf] - idx
+        self.clade_class_ids = self.leaf_class_ids[first_leaf:end_leaf]
+        self.clade_parents = self.parent_indices[idx:end] - idx
+        depths = self.depths[idx:end] - self.depths[idx]
+        self.clade_levels = [np.flatnonzero(depths == depth)
+                             for depth in range(depths.max(), 0, -1)]
+
+        # the path to the clade; all scores are within the clade
+        self.clade_path = []
+        while idx: # not root
+            taxon = self.get_taxon(idx)
+            self.clade_path.append((1.0, taxon.taxon_id, taxon.get_rank(),
+                                    taxon.get_name()))
+            idx = self.parent_indices[idx]
+        self.clade_path.reverse()
+
+    # Returns the indices of the taxa with scientific name `name'.
+    def find_name(self, name):
+        key = name.encode('utf-8')
+        indices = []
+        pos = self.names.find(key)
+        while pos >= 0:
+            idx = int(np.searchsorted(self.name_offsets, pos, side='right')) - 1
+            if self.name_offsets[idx] == pos and \
+               self.name_offsets[idx+1] == pos + len(key):
+                indices.append(idx)
+            pos = self.names.find(key, pos + 1)
+        return indices
+
+    # Returns the indices of the taxa with taxon id or scientific name
+    # `taxon'.
+    def find_taxon(self, taxon):
+        if not self.taxonomy_available():
+            return []
+        taxon = str(taxon)
+        if taxon.lstrip('-').isdigit():
+            return np.flatnonzero(self.taxon_ids == int(taxon)).tolist()
+        return self.find_name(taxon)
+
+    # Restrict predictions to the subtree of a taxon given by its taxon id or
+    # scientific name; scores are renormalized within the subtree. Returns
+    # False if the taxon cannot be found.
+    def restrict(self, taxon):
+        if not self.taxonomy_available():
+            print(f"Error: cannot restrict predictions to '{taxon}' "
+                  "without a taxonomy.")
+            return False
+        indices = self.find_taxon(taxon)
+        if len(indices) != 1:
+            if indices:
+                ids = ', '.join(str(self.taxon_ids[idx]) for idx in indices)
+                print(f"Error: taxon name '{taxon}' is ambiguous, use one of "
+                      f"the taxon ids {ids}.")
+            else:
+                print(f"Error: taxon '{taxon}' not found in taxonomy.")
+            return False
+        self.set_clade(indices[0])
+        return True
+
+    # The snapshot of a taxonomy file is stored next to it.
+    @staticmethod
+    def snapshot_filename(filename):
+        return os.path.splitext(filename)[0] + '.npz'
+
+    @staticmethod
+    def file_hash(filename):
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    # Write the compiled tree to a binary snapshot of the taxonomy file.
+    # `csv_hash' is the hash of the file if already known.
+    def write_snapshot(self, filename, csv_hash=None):
+        snapshot = self.snapshot_filename(filename)
+        stat = os.stat(filename)
+        if csv_hash is None:
+            csv_hash = self.file_hash(filename)
+        tmp_filename = f'{snapshot}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_filename, 'wb') as f:
+                np.savez(f, version=np.int64(self.SNAPSHOT_VERSION),
+                         csv_mtime=np.int64(stat.st_mtime_ns),
+                         csv_size=np.int64(stat.st_size),
+                         csv_hash=np.str_(csv_hash),
+                         taxon_ids=self.taxon_ids,
+                         rank_levels=self.rank_levels,
+                         parent_indices=self.parent_indices,
+                         depths=self.depths,
+                         leaf_taxon_indices=self.leaf_taxon_indices,
+                         leaf_class_ids=self.leaf_class_ids,
+                         names=np.frombuffer(self.names, dtype=np.uint8),
+                         name_offsets=self.name_offsets)
+            os.replace(tmp_filename, snapshot)
+        except Exception as e:
+            print(f"Failure writing taxonomy snapshot '{snapshot}':", str(e))
+            try:
+                os.remove(tmp_filename)
+            except Exception:
+                pass
 
-    # propagate scores to taxon and all below
-    def assign_scores(self, taxon, scores):
-        taxon.score = 0.0
-        for leaf_class_id in taxon.leaf_class_ids:
-            taxon.score += scores[leaf_class_id]
-        for child in taxon.children:
-            self.assign_scores(child, scores)
-            taxon.score += child.score
-
-    # Returns list of 5-tuples (score, taxon_id, taxonomic rank,
-    # scientific name, common name) ordered by taxonomic rank from kingdom
-    # down to e.g. species.
+    # Read the compiled tree from the snapshot of a taxonomy file. Returns
+    # False if there is no snapshot or if it is out of date. If only the
+    # modification time or size of the file changed, e.g. after a checkout
+    # or copy, but not its contents, the snapshot is rewritten with the new
+    # ones so that later runs need not hash the file again.
+    def read_snapshot(self, filename):
+        snapshot = self.snapshot_filename(filename)
+        if not os.path.isfile(snapshot):
+            return False
+        csv_hash = None # set if the file was hashed
+        try:
+            with np.load(snapshot) as data:
+                if data['version'] != self.SNAPSHOT_VERSION:
+                    return False
+                stat = os.stat(filename)
+                if data['csv_mtime'] != stat.st_mtime_ns or \
+                   data['csv_size'] != stat.st_size:
+                    csv_hash = self.file_hash(filename)
+                    if str(data['csv_hash']) != csv_hash:
+                        return False
+                taxon_ids = data['taxon_ids']
+                self.rank_levels = data['rank_levels']
+                self.parent_indices = data['parent_indices']
+                self.depths = data['depths']
+                self.leaf_taxon_indices = data['leaf_taxon_indices']
+                self.leaf_class_ids = data['leaf_class_ids']
+                self.names = data['names'].tobytes()
+                self.name_offsets = data['name_offsets']
+        except Exception as e:
+            print(f"Cannot read taxonomy snapshot '{snapshot}': {str(e)}.")
+            return False
+
+        self.taxon_ids = taxon_ids
+        self.index_tree()
+        if csv_hash is not None:
+            self.write_snapshot(filename, csv_hash)
+        return True
+
+    # Confidence of a model in its prediction: the highest label score
+    # relative to the sum of the label scores, only those of the clade when
+    # restricted.
+    def confidence(self, scores):
+        if self.clade_idx:
+            scores = scores[self.clade_class_ids]
+        total = float(np.sum(scores))
+        return float(np.max(scores)) / total if total else 0.0
+
+    # Propagate scores to all taxa of the clade, returns array of scores in
+    # pre-order; index 0 is the clade, the root unless restricted.
+    def compute_scores(self, scores):
+        # scores of each taxon's own labels
+        taxon_scores = np.bincount(self.clade_leaf_indices,
+                                   weights=scores[self.clade_class_ids],
+                                   minlength=len(self.clade_parents))
+        # Add each level's scores to their parents, deepest level first. The
+        # children of each taxon are added in order, hence the sums are
+        # identical to those of a recursive traversal.
+        for level in self.clade_levels:
+            np.add.at(taxon_scores, self.clade_parents[level],
+                      taxon_scores[level])
+        return taxon_scores
+
+    # Returns list of 4-tuples (score, taxon_id, taxonomic rank, name)
+    # ordered by taxonomic rank from kingdom down to e.g. species.
     # Returns pairs (score, scientific name) if label_scores_only
     # is set.
+    # Returns a list of up to top_k such lists of 4-tuples, see best_paths,
+    # if top_k is larger than 1.
+    # When restricted to a clade, only the labels in the clade are considered
+    # and their scores add up to 1; paths start with the clade's ancestors.
     def prediction(self, scores):
 
         if label_scores_only:
             # return list of pairs (score, scientific name)
-            total = np.sum(scores)
-            indices = np.argpartition(scores, -result_sz)[-result_sz:]
-            results = [(scores[i] / total, self.idx2label[i])
+            if self.clade_idx:
+                labels = self.clade_class_ids
+                clade_scores = scores[labels]
+                total = np.sum(clade_scores)
+                size = min(result_sz, len(labels))
+                indices = labels[np.argpartition(clade_scores,
+                                                 -size)[-size:]]
+            else:
+                total = np.sum(scores)
+                indices = np.argpartition(scores, -result_sz)[-result_sz:]
+            results = [(scores[i] / total, self.get_label(i))
                        for i in indices if scores[i] != 0]
             results.sort(reverse=True)
             return results
 
-        # annotate all taxa across the hierarchy with scores.
-        self.assign_scores(self.root, scores)
+        # annotate all taxa of the clade with scores, relative to the clade.
+        taxon_scores = self.compute_scores(scores)
+        if not taxon_scores[0]:
+            return []
+
+        if top_k > 1:
+            return self.best_paths(taxon_scores, top_k)
 
         # return one hierarchical path guided by scores
-        path = []
-        taxon = self.root
-        while taxon.children:
+        return self.path_to(self.descend(taxon_scores), taxon_scores)
+
+    # Returns the index of the taxon where the hierarchical path guided by
+    # scores ends. The path descends from the clade to the child with the
+    # highest score; it is truncated at a taxon if all the other children
+    # combined are better.
+    def descend(self, taxon_scores):
+        first = self.clade_idx
+        idx = first
+        while self.child_offsets[idx] < self.child_offsets[idx+1]:
             # Find child with highest score.
-            best_child = None
-            for child in taxon.children:
-                if not best_child or child.score > best_child.score:
-                    best_child = child
+            children = self.child_indices[self.child_offsets[idx]:
+                                          self.child_offsets[idx+1]]
+            best_child = children[np.argmax(taxon_scores[children - first])]
 
             # Truncate path if all the other children combined are better
-            if best_child.score < 0.5 * taxon.score:
+            if taxon_scores[best_child - first] < \
+               0.5 * taxon_scores[idx - first]:
                 break
 
-            path.append((best_child.score / self.root.score,
-                         best_child.taxon_id, best_child.get_rank(),
-                         best_child.get_name()))
-
-            taxon = best_child
-
-        return path
+            idx = best_child
+        return idx
+
+    # Returns the `k' best hierarchical paths. The first path is the one
+    # prediction returns for top_k 1, the alternatives follow ordered by
+    # score. Like the first path, they end at a leaf taxon or where they
+    # would be truncated, at a taxon whose children all have less than half
+    # of its score. A best-first search visits the taxa in the order of their
+    # scores, which never increase down the tree; it only expands taxa that
+    # score at least as high as the k-th path. Paths that end at a truncated
+    # taxon are followed further down to alternatives among its children.
+    def best_paths(self, taxon_scores, k):
+        first = self.clade_idx
+        best = self.descend(taxon_scores)
+        paths = [self.path_to(best, taxon_scores)] if best else []
+        heap = [(-taxon_scores[0], first)] # (negative score, index)
+        while heap and len(paths) < k:
+            score, idx = heapq.heappop(heap)
+            children = self.child_indices[self.child_offsets[idx]:
+                                          self.child_offsets[idx+1]]
+            child_scores = taxon_scores[children - first]
+            if idx and idx != best and (len(children) == 0 or
+                                        child_scores.max() < -0.5 * score):
+                paths.append(self.path_to(idx, taxon_scores))
+            for child, child_score in zip(children.tolist(),
+                                          child_scores.tolist()):
+                if child_score > 0:
+                    heapq.heappush(heap, (-child_score, child))
+        return paths
+
+    # Returns the path from the root to the taxon with index `idx' as a list
+    # of 4-tuples like prediction.
+    def path_to(self, idx, taxon_scores):
+        path = []
+        while idx != self.clade_idx:
+            taxon = self.get_taxon(idx)
+            path.append((taxon_scores[idx - self.clade_idx] / taxon_scores[0],
+                         taxon.taxon_id, taxon.get_rank(), taxon.get_name()))
+            idx = self.parent_indices[idx]
+        path.reverse()
+        return self.clade_path + path
 
 #
 # Offline image classification.
 #
 
-class OfflineClassifier:
+# Histogram of the durations of a stage with four buckets per power of two
+# nanoseconds.
+class Histogram:
 
-    def __init__(self, filenames):
-        self.min_pixel_value = 0.0
-        self.max_pixel_value = 255.0
+    BUCKETS_PER_OCTAVE = 4
 
-        if os.path.split(filenames[0])[1] in ['optimized_model.tflite',
-                                              'optimized_model_v1.tflite']:
-            self.min_pixel_value = -1.0
-            self.max_pixel_value = 1.0
+    def __init__(self):
+        self.count = 0
+        self.total = 0 # nanoseconds
+        self.min = None
+        self.max = None
+        self.buckets = collections.Counter()
+
+    def add(self, nanoseconds):
+        self.count += 1
+        self.total += nanoseconds
+        if self.min is None or nanoseconds < self.min:
+            self.min = nanoseconds
+        if self.max is None or nanoseconds > self.max:
+            self.max = nanoseconds
+        self.buckets[int(math.log2(max(nanoseconds, 1)) *
+                         self.BUCKETS_PER_OCTAVE)] += 1
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.buckets.update(other.buckets)
+
+    # Upper bound of the bucket that holds the `fraction' percentile.
+    def percentile(self, fraction):
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= fraction * self.count:
+                return min(2 ** ((bucket + 1) / self.BUCKETS_PER_OCTAVE),
+                           self.max)
+        return self.max
+
+    # Returns dictionary of statistics in milliseconds.
+    def summary(self):
+        if not self.count:
+            return { 'count' : 0 }
+        return { 'count'   : self.count,
+                 'total_ms': self.total / 1e6,
+                 'mean_ms' : self.total / self.count / 1e6,
+                 'min_ms'  : self.min / 1e6,
+                 'p50_ms'  : self.percentile(0.5) / 1e6,
+                 'p90_ms'  : self.percentile(0.9) / 1e6,
+                 'p99_ms'  : self.percentile(0.99) / 1e6,
+                 'max_ms'  : self.max / 1e6 }
+
+# Timing of the stages of classification: open, decode, exif_transpose, crop,
+# resize, to_array, tensor_build, invoke, and prediction. A stage calls
+#
+#    start = instrumentation.record('stage', start)
+#
+# with the perf_counter_ns() value of its start and gets the start of the next
+# stage. Each stage has a histogram, and callbacks registered with
+# add_callback are called with the stage and its duration in nanoseconds.
+class Instrumentation:
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.histograms = {}
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def record(self, stage, start):
+        now = time.perf_counter_ns()
+        nanoseconds = now - start
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].add(nanoseconds)
+        for callback in self.callbacks:
+            callback(stage, nanoseconds)
+        return now
+
+    # Returns a copy of the histograms, a dictionary stage -> Histogram.
+    def get_histograms(self):
+        with self.lock:
+            histograms = {}
+            for stage, histogram in self.histograms.items():
+                histograms[stage] = Histogram()
+                histograms[stage].merge(histogram)
+            return histograms
+
+    # Adds the histograms of another process.
+    def merge(self, histograms):
+        with self.lock:
+            for stage, histogram in histograms.items():
+                if stage not in self.histograms:
+                    self.histograms[stage] = Histogram()
+                self.histograms[stage].merge(histogram)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def summary(self):
+        return { stage : histogram.summary()
+                 for stage, histogram in self.get_histograms().items() }
+
+    # Print a table of the stages.
+    def report(self, file=None):
+        print(f"\n{'stage':15s} {'count':>8s} {'total ms':>11s} "
+              f"{'mean ms':>9s} {'p50 ms':>9s} {'p90 ms':>9s} {'p99 ms':>9s} "
+              f"{'max ms':>9s}", file=file)
+        for stage, s in self.summary().items():
+            print(f"{stage:15s} {s['count']:8d} {s['total_ms']:11.1f} "
+                  f"{s['mean_ms']:9.3f} {s['p50_ms']:9.3f} {s['p90_ms']:9.3f} "
+                  f"{s['p99_ms']:9.3f} {s['max_ms']:9.3f}", file=file)
+
+instrumentation = Instrumentation()
+
+# Persistent cache of model outputs. The key is a hash of an image file's
+# contents and of the model's identity, the value is the raw score vector of
+# the model. A hit is turned into a result with the current taxonomy, both
+# hierarchically and with option label_scores_only. The cache is an SQLite
+# database, see sqlite_cache; several processes can share it.
+class ResultCache(sqlite_cache.SqliteCache):
+
+    TABLE = 'results'
+    SIZE  = 'LENGTH(scores)'
+
+    def __init__(self, filename, max_size=RESULT_CACHE_MAX_SIZE):
+        super().__init__(filename, max_size)
+        self.hits = 0
+        self.misses = 0
+
+    def create_tables(self, db):
+        db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, '
+                   'accessed REAL, dtype TEXT, scores BLOB)')
+        db.execute('CREATE TABLE IF NOT EXISTS models (path TEXT PRIMARY KEY, '
+                   'size INTEGER, mtime INTEGER, hash TEXT)')
+
+    # Hash of a model file, computed once for each version of the file.
+    def model_hash(self, model_path):
+        model_path = os.path.abspath(model_path)
+        stat = os.stat(model_path)
+        with self.lock:
+            row = self.connect().execute('SELECT hash FROM models WHERE path '
+                                         '= ? AND size = ? AND mtime = ?',
+                                         (model_path, stat.st_size,
+                                          stat.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+        hash = Taxonomy.file_hash(model_path)
+        with self.lock:
+            self.connect().execute('INSERT OR REPLACE INTO models VALUES '
+                                   '(?, ?, ?, ?)', (model_path, stat.st_size,
+                                                    stat.st_mtime_ns, hash))
+        return hash
+
+    # Key for the contents of an image file classified by a model.
+    @staticmethod
+    def key(model_id, data):
+        hash = hashlib.blake2b(digest_size=20)
+        hash.update(model_id.encode('utf-8'))
+        hash.update(data)
+        return hash.hexdigest()
+
+    # returns cached scores or None
+    def get(self, key):
+        with self.lock:
+            db = self.connect()
+            row = db.execute('SELECT dtype, scores FROM results WHERE key = ?',
+                             (key,)).fetchone()
+            if not row:
+                self.misses += 1
+                return None
+            self.hits += 1
+            db.execute('UPDATE results SET accessed = ? WHERE key = ?',
+                       (time.time(), key))
+            return np.frombuffer(row[1], dtype=row[0])
+
+    # store list of pairs (key, scores)
+    def put(self, entries):
+        with self.transaction() as db:
+            tim = time.time()
+            for key, scores in entries:
+                row = db.execute('SELECT 1 FROM results WHERE key = ?',
+                                 (key,)).fetchone()
+                if row:
+                    continue
+                scores = np.ascontiguousarray(scores)
+                db.execute('INSERT INTO results VALUES (?, ?, ?, ?)',
+                           (key, tim, scores.dtype.str, scores.tobytes()))
+                self.add_size(db, scores.nbytes)
+            self.evict(db)
+
+    # Adds the counters of another process to ours.
+    def add_counters(self, hits, misses):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+# An image on its way through the classifier: `pixels' are the model's input,
+# `scores' are cached scores, `key' is the image's key in the result cache.
+# Both pixels and scores are None if an image could not be loaded.
+LoadedImage = collections.namedtuple('LoadedImage',
+                                     ['filename', 'pixels', 'scores', 'key'])
+
+# Generates pairs (item, function(item)) in the order of `items'. With
+# `workers' greater than 0, the function is applied by a pool of threads with
+# at most `window' items in flight.
+def ordered_map(function, items, workers=0, window=16):
+    if workers <= 0:
+        for item in items:
+            yield item, function(item)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            if len(pending) >= window:
+                done_item, future = pending.popleft()
+                yield done_item, future.result()
+            pending.append((item, executor.submit(function, item)))
+        while pending:
+            done_item, future = pending.popleft()
+            yield done_item, future.result()
+
+# A TFLite interpreter with its own tensors. Interpreters created from the
+# same model file share the memory-mapped model. An interpreter must not be
+# used by more than one thread at a time. Images are passed as arrays of
+# uint8 pixels; pixel values are mapped to the range `min_pixel_value' ...
+# `max_pixel_value' of the model's input. The input tensor holds `batch_size'
+# images; it is sized once, resizing it reallocates the tensors.
+class ModelInterpreter:
+
+    def __init__(self, model_path, num_threads=None, min_pixel_value=0.0,
+                 max_pixel_value=255.0, batch_size=1):
         # Load TFLite model and allocate tensors.
-        self.mInterpreter = tflite.Interpreter(model_path=filenames[0])
+        self.mInterpreter = import_tflite().Interpreter(
+                              model_path=model_path, num_threads=num_threads)
         self.mInterpreter.allocate_tensors()
 
         # Get input and output tensors.
         self.mInput_details = self.mInterpreter.get_input_details()
         self.mOutput_details = self.mInterpreter.get_output_details()
+        self.set_batch_size(batch_size)
+
+        # Lookup table that maps the 256 pixel values to input values, None
+        # if the model takes uint8 pixels as they are.
+        self.mLut = None
+        dtype = self.mInput_details[0]['dtype']
+        if dtype != np.uint8:
+            self.mLut = np.arange(256, dtype=np.uint8).astype(dtype)
+            if dtype == np.float32:
+                self.mLut *= (max_pixel_value - min_pixel_value) / 255.0
+                self.mLut += min_pixel_value
+
+    # Number of images the interpreter processes in one call.
+    def get_batch_size(self):
+        return self.mInput_details[0]['shape'][0]
+
+    # Resize the interpreter's input tensor to hold `batch_size' images.
+    def set_batch_size(self, batch_size):
+        if batch_size == self.get_batch_size():
+            return
+        shape = list(self.mInput_details[0]['shape'])
+        shape[0] = batch_size
+        try:
+            self.mInterpreter.resize_tensor_input(
+                self.mInput_details[0]['index'], shape)
+            self.mInterpreter.allocate_tensors()
+        except Exception as e:
+            print(f"Cannot resize model input to batch size {batch_size}: "
+                  f"{str(e)}; classifying one image at a time.")
+            shape[0] = 1
+            self.mInterpreter.resize_tensor_input(
+                self.mInput_details[0]['index'], shape)
+            self.mInterpreter.allocate_tensors()
+        self.mInput_details = self.mInterpreter.get_input_details()
+        self.mOutput_details = self.mInterpreter.get_output_details()
 
-        # Read labels or taxonomy
-        self.mTaxonomy = Taxonomy()
-        self.mTaxonomy.read_taxonomy(filenames[1])
+    # Run the model on a list of images, returns array of scores with one
+    # row per image. The pixels are written to the input tensor in place,
+    # mapped by the lookup table if the model does not take uint8 input.
+    # Images are classified in chunks of the interpreter's batch size.
+    def invoke(self, images):
+        n = self.get_batch_size()
+        outputs = []
+        for chunk in range(0, len(images), n):
+            start = time.perf_counter_ns()
+            # The view of the input tensor must be released before the call
+            # of the interpreter. Rows beyond a short chunk keep the previous
+            # images; their scores are dropped.
+            input_data = self.mInterpreter.tensor(
+                           self.mInput_details[0]['index'])()
+            for row, pixels in enumerate(images[chunk:chunk+n]):
+                if self.mLut is None:
+                    input_data[row] = pixels
+                else:
+                    np.take(self.mLut, pixels, out=input_data[row],
+                            mode='clip')
+            del input_data
+            start = instrumentation.record('tensor_build', start)
+            self.mInterpreter.invoke()
+
+            output_data = self.mInterpreter.get_tensor(
+                            self.mOutput_details[0]['index'])
+            outputs.append(output_data[:len(images) - chunk])
+            instrumentation.record('invoke', start)
+        return np.concatenate(outputs)
+
+# Returns the contents of an image file or of an uploaded image, None on
+# error.
+def read_image_data(image_filename):
+    try:
+        if isinstance(image_filename, io.BytesIO):
+            return image_filename.getvalue()
+        with open(image_filename, 'rb') as f:
+            return f.read()
+    except:
+        print(f"Error: cannot load image '{image_filename}'.")
+        return None
+
+# Load image, rotate it, and crop it to square shape. JPEG images are decoded
+# at a reduced scale with both sides at least as long as `size', the model's
+# input size, unless full_decode is set. Returns PIL image or None on error.
+# The image is read from `image_file' if given.
+def load_square_image(image_filename, image_file, size):
+    start = time.perf_counter_ns()
+    try:
+        img = Image.open(image_filename if image_file is None
+                         else image_file)
+    except:
+        print(f"Error: cannot load image '{image_filename}'.")
+        return None
+
+    if img.mode != 'RGB':
+        print(f"Error: image '{image_filename}' is of mode '{img.mode}',"
+              " only mode RGB is supported.")
+        return None
+
+    if not full_decode:
+        # Have the JPEG decoder scale the image down by 1/2, 1/4, or 1/8
+        # while both sides remain at least as long as the model's input;
+        # the square crop below is then still larger than the model size.
+        # This is a no-op for other file formats.
+        img.draft('RGB', size)
+    start = instrumentation.record('open', start)
+
+    img.load()
+    start = instrumentation.record('decode', start)
+
+    # rotate image if needed as it may contain EXIF orientation tag
+    img = ImageOps.exif_transpose(img)
+    start = instrumentation.record('exif_transpose', start)
+
+    width, height = img.size
+    if width != height:
+        # Before scaling, we crop image to square shape.
+        left = 0
+        right = width
+        top = 0
+        bottom = height
+        if width < height:
+            top = (height - width) / 2
+            bottom = top + width
+        else:
+            left = (width - height) / 2
+            right = left + height
+        img = img.crop((left, top, right, bottom))
+    instrumentation.record('crop', start)
+
+    return img
+
+# The classification pipeline shared by OfflineClassifier and
+# EnsembleClassifier. Subclasses load images with method load, classify
+# batches of loaded images with method predict_batch, and tell how many
+# batches they classify concurrently with method get_pool_size.
+class Classifier:
+
+    # Generates LoadedImages in the order of `image_filenames'. With
+    # `loader_threads' greater than 0, images are decoded and scaled by a
+    # pool of threads while the interpreter runs; at most `queue_depth'
+    # images are loaded ahead of the consumer.
+    def load_images(self, image_filenames, loader_threads=0, queue_depth=16):
+        for _, image in ordered_map(self.load, image_filenames,
+                                    loader_threads, queue_depth):
+            yield image
+
+    # Group LoadedImages into batches with `batch_size' images for the
+    # interpreter each; the last batch may be shorter.
+    @staticmethod
+    def make_batches(images, batch_size):
+        batch = []
+        num_loaded = 0
+        for image in images:
+            batch.append(image)
+            if image.pixels is not None:
+                num_loaded += 1
+            if num_loaded == batch_size:
+                yield batch
+                batch = []
+                num_loaded = 0
+        if batch:
+            yield batch
+
+    # Classifies images in batches of up to `batch_size' images per call of
+    # the interpreter. Generates pairs (filename, result) in the order of
+    # `image_filenames'; the result is an empty list if an image could not
+    # be loaded. See load_images for `loader_threads' and `queue_depth'.
+    # The interpreters of the pool classify batches concurrently.
+    def classify_images(self, image_filenames, batch_size=1,
+                        loader_threads=0, queue_depth=16):
+        batches = self.make_batches(self.load_images(image_filenames,
+                                                     loader_threads,
+                                                     queue_depth), batch_size)
+        pool_size = self.get_pool_size()
+        workers = pool_size if pool_size > 1 else 0
+        start_time = time.perf_counter()
+        for batch, results in ordered_map(self.predict_batch, batches,
+                                          workers, 2 * pool_size):
+            elapsed = (time.perf_counter() - start_time) / len(batch)
+            for image, result in zip(batch, results):
+                if image.pixels is not None or image.scores is not None:
+                    print()
+                    print(f"Classification of '{image.filename}' took "
+                          f"{elapsed:.3f} secs.")
+                yield image.filename, result
+            start_time = time.perf_counter()
 
     def classify_image(self, image_filename):
-        start_time = time.time()
-        try:
-            img = Image.open(image_filename)
-        except:
-            print(f"Error: cannot load image '{image_filename}'.")
-            return []
+        for _, result in self.classify_images([image_filename]):
+            return result
+
+class OfflineClassifier(Classifier):
+
+    # A pool of `pool_size' interpreters allows concurrent classification;
+    # each interpreter uses `num_threads' threads, by default as many as
+    # TFLite sees fit, and classifies up to `batch_size' images per call,
+    # the batch size of classify_images. The scores of classified images
+    # are stored in `result_cache', a ResultCache, and looked up there
+    # before images are decoded.
+    def __init__(self, filenames, pool_size=1, num_threads=None,
+                 result_cache=None, batch_size=1):
+        self.min_pixel_value = 0.0
+        self.max_pixel_value = 255.0
 
-        if img.mode != 'RGB':
-            print(f"Error: image '{image_filename}' is of mode '{img.mode}',"
-                  " only mode RGB is supported.")
-            return []
+        if os.path.split(filenames[0])[1] in ['optimized_model.tflite',
+                                              'optimized_model_v1.tflite']:
+            self.min_pixel_value = -1.0
+            self.max_pixel_value = 1.0
 
-        # rotate image if needed as it may contain EXIF orientation tag
-        img = ImageOps.exif_transpose(img)
+        # The pool of interpreters is created on first use, in the process
+        # that classifies; worker processes are forked before.
+        self.mModel_path = filenames[0]
+        self.mPool_size = pool_size
+        self.mNum_threads = num_threads
+        self.mBatch_size = batch_size
+        self.mLock = threading.Lock()
+        self.mInterpreters = None # idle interpreters
+        self.mPid = None          # process that created the interpreters
+        self.mInherited = []      # interpreters of parent processes
+
+        # Get shape of input from a single-threaded interpreter.
+        interpreter = ModelInterpreter(self.mModel_path, 1)
+        self.mModel_size = tuple(interpreter.mInput_details[0]['shape'][1:3])
+        del interpreter
 
-        model_size = tuple(self.mInput_details[0]['shape'][1:3])
+        # Read labels or taxonomy
+        self.mTaxonomy = Taxonomy()
+        self.mTaxonomy.read_taxonomy(filenames[1])
 
-        # square target shape expected by crop code below
+        # The model's identity includes everything that affects its scores.
+        self.mResult_cache = result_cache
+        if result_cache:
+            self.mModel_id = f'{result_cache.model_hash(filenames[0])}:'\
+                             f'{self.min_pixel_value}:{self.max_pixel_value}:'\
+                             f'{full_decode}'
+
+    def get_result_cache(self):
+        return self.mResult_cache
+
+    # Identifies the model file and its preprocessing, cheaply.
+    def get_model_id(self):
+        stat = os.stat(self.mModel_path)
+        return f'{os.path.basename(self.mModel_path)}:{stat.st_size}:'\
+               f'{stat.st_mtime_ns}:{self.min_pixel_value}:'\
+               f'{self.max_pixel_value}:{full_decode}'
+
+    # Create the pool of interpreters for this process.
+    def create_interpreters(self):
+        self.mInterpreters = queue.Queue() # idle interpreters
+        for _ in range(self.mPool_size):
+            self.mInterpreters.put(ModelInterpreter(self.mModel_path,
+                                                    self.mNum_threads,
+                                                    self.min_pixel_value,
+                                                    self.max_pixel_value,
+                                                    self.mBatch_size))
+        self.mPid = os.getpid()
+
+    # Take an idle interpreter from the pool, create the pool on first use.
+    # A forked child process cannot use the interpreters of its parent; it
+    # creates its own pool. It keeps the parent's interpreters, their
+    # destructors would wait for threads that do not exist in the child.
+    def acquire_interpreter(self):
+        with self.mLock:
+            if self.mPid != os.getpid():
+                if self.mInterpreters is not None:
+                    self.mInherited.append(self.mInterpreters)
+                self.create_interpreters()
+            interpreters = self.mInterpreters
+        return interpreters.get()
+
+    def release_interpreter(self, interpreter):
+        self.mInterpreters.put(interpreter)
+
+    # Number of interpreters that classify concurrently.
+    def get_pool_size(self):
+        return self.mPool_size
+
+    # Restrict predictions to the subtree of `taxon', see Taxonomy.restrict.
+    # Returns False if the taxon cannot be found.
+    def restrict(self, taxon):
+        return self.mTaxonomy.restrict(taxon)
+
+    # Load image, rotate, crop, and scale it to the model's input size.
+    # Returns numpy array of uint8 pixels or None on error. The image is read
+    # from `image_file' if given.
+    def load_image(self, image_filename, image_file=None):
+        img = load_square_image(image_filename, image_file, self.mModel_size)
+        return self.image_to_input(img) if img is not None else None
+
+    # Scale a square PIL image to the model's input size, returns numpy
+    # array of uint8 pixels. The interpreter maps them to the model's input.
+    def image_to_input(self, img):
+        start = time.perf_counter_ns()
+        model_size = self.mModel_size
+
+        # square target shape, load_square_image crops to square shape
         assert model_size[0] == model_size[1]
 
         if img.size != model_size:
-            # We need to scale and maybe want to crop image.
-            width, height = img.size
-            if width != height:
-                # Before scaling, we crop image to square shape.
-                left = 0
-                right = width
-                top = 0
-                bottom = height
-                if width < height:
-                    top = (height - width) / 2
-                    bottom = top + width
-                else:
-                    left = (width - height) / 2
-                    right = left + height
-                img = img.crop((left, top, right, bottom))
-
             # scale image
             img = img.resize(model_size)
+        start = instrumentation.record('resize', start)
 
         #img.show()
 
         # pixels are in range 0 ... 255, turn into numpy array
-        input_data = np.array([np.array(img, self.mInput_details[0]['dtype'])])
+        input_data = np.asarray(img)
+        instrumentation.record('to_array', start)
+
+        return input_data
+
+    # Key of the scores of an image with contents `data' decoded for an input
+    # of `decode_size'. Unless full_decode is set, the JPEG decoder's scale
+    # and hence the scores depend on it when it differs from the model size,
+    # as in an ensemble with a larger model.
+    def result_key(self, data, decode_size):
+        model_id = self.mModel_id
+        if not full_decode and decode_size != self.mModel_size:
+            model_id += f':{decode_size[0]}x{decode_size[1]}'
+        return self.mResult_cache.key(model_id, data)
+
+    # Returns a LoadedImage. With a result cache, the image file is hashed
+    # and only decoded if its scores are not in the cache.
+    def load(self, image_filename):
+        if self.mResult_cache is None:
+            return LoadedImage(image_filename,
+                               self.load_image(image_filename), None, None)
+
+        data = read_image_data(image_filename)
+        if data is None:
+            return LoadedImage(image_filename, None, None, None)
+
+        key = self.result_key(data, self.mModel_size)
+        scores = self.mResult_cache.get(key)
+        if scores is not None:
+            return LoadedImage(image_filename, None, scores, key)
+        return LoadedImage(image_filename,
+                           self.load_image(image_filename, io.BytesIO(data)),
+                           None, key)
+
+    # Returns the scores for a list of LoadedImages, None for images that
+    # could not be loaded. Takes an idle interpreter from the pool,
+    # concurrent threads can call this method.
+    def score_batch(self, batch):
+        scores = [image.scores for image in batch]
+        loaded = [i for i in range(len(batch)) if batch[i].pixels is not None]
+
+        if loaded:
+            interpreter = self.acquire_interpreter()
+            try:
+                output_data = interpreter.invoke([batch[i].pixels
+                                                  for i in loaded])
+            finally:
+                self.release_interpreter(interpreter)
+            for row, i in enumerate(loaded):
+                scores[i] = output_data[row]
+            if self.mResult_cache:
+                self.mResult_cache.put([(batch[i].key, scores[i])
+                                        for i in loaded])
+        return scores
+
+    # Classify a list of LoadedImages, returns list of results. Concurrent
+    # threads can call this method.
+    def predict_batch(self, batch):
+        results = []
+        for image_scores in self.score_batch(batch):
+            start = time.perf_counter_ns()
+            results.append(self.mTaxonomy.prediction(image_scores)
+                           if image_scores is not None else [])
+            instrumentation.record('prediction', start)
+        return results
+
+# The result of an ensemble of models, a result as returned by
+# Taxonomy.prediction that also names the model it comes from.
+class ModelResult(list):
+
+    def __init__(self, model, result):
+        super().__init__(result)
+        self.model = model
+
+# Classifies images with several models, instances of OfflineClassifier named
+# `model_names'. Each image is decoded, rotated, and cropped once and then
+# scaled to the input size of each model; the models classify a batch
+# concurrently. For each image, the result of the most confident model, the
+# one with the highest label score, is reported as a ModelResult.
+class EnsembleClassifier(Classifier):
+
+    def __init__(self, classifiers, model_names):
+        self.mClassifiers = classifiers
+        self.mModel_names = model_names
+        # decode images large enough for the largest model input
+        self.mImage_size = max(classifier.mModel_size
+                               for classifier in classifiers)
+        # One thread per model scores a batch; the threads are created on
+        # first use, in the process that classifies, and reused.
+        self.mLock = threading.Lock()
+        self.mExecutor = None
+        self.mPid = None
+
+    def get_result_cache(self):
+        return self.mClassifiers[0].get_result_cache()
+
+    def get_model_id(self):
+        return ','.join(f'{name}:{classifier.get_model_id()}'
+                        for name, classifier in zip(self.mModel_names,
+                                                    self.mClassifiers))
+
+    # Number of batches classified concurrently, each by all models.
+    def get_pool_size(self):
+        return self.mClassifiers[0].get_pool_size()
+
+    # Restrict predictions to the subtree of `taxon' in the models whose
+    # taxonomy contains it, the other models are dropped. Returns False if
+    # no model contains the taxon.
+    def restrict(self, taxon):
+        models = [model for model, classifier in enumerate(self.mClassifiers)
+                  if classifier.mTaxonomy.find_taxon(taxon)]
+        if not models:
+            print(f"Error: taxon '{taxon}' not found in the taxonomy of any "
+                  "model.")
+            return False
+        for model in range(len(self.mClassifiers)):
+            if model not in models:
+                print(f"Info: taxon '{taxon}' not found in the taxonomy of "
+                      f"model '{self.mModel_names[model]}', not using this "
+                      "model.")
+        for model in models:
+            if not self.mClassifiers[model].restrict(taxon):
+                return False
+        self.mClassifiers = [self.mClassifiers[model] for model in models]
+        self.mModel_names = [self.mModel_names[model] for model in models]
+        self.mImage_size = max(classifier.mModel_size
+                               for classifier in self.mClassifiers)
+        return True
+
+    # Returns a LoadedImage with lists of pixels, scores, and keys, one entry
+    # for each model. With a result cache, the image is only decoded if the
+    # scores of a model are not in the cache.
+    def load(self, image_filename):
+        image_file = None
+        scores = keys = None
+        cache = self.get_result_cache()
+        if cache:
+            data = read_image_data(image_filename)
+            if data is None:
+                return LoadedImage(image_filename, None, None, None)
+            keys = [classifier.result_key(data, self.mImage_size)
+                    for classifier in self.mClassifiers]
+            scores = [cache.get(key) for key in keys]
+            if all(model_scores is not None for model_scores in scores):
+                return LoadedImage(image_filename, None, scores, keys)
+            image_file = io.BytesIO(data)
+
+        img = load_square_image(image_filename, image_file, self.mImage_size)
+        if img is None:
+            return LoadedImage(image_filename, None, None, keys)
+        pixels = [classifier.image_to_input(img)
+                  if scores is None or scores[model] is None else None
+                  for model, classifier in enumerate(self.mClassifiers)]
+        return LoadedImage(image_filename, pixels, scores, keys)
+
+    # The LoadedImages of a batch for the model with index `model'.
+    @staticmethod
+    def model_batch(batch, model):
+        return [LoadedImage(image.filename,
+                            None if image.pixels is None
+                            else image.pixels[model],
+                            None if image.scores is None
+                            else image.scores[model],
+                            None if image.key is None else image.key[model])
+                for image in batch]
+
+    # The executor of the models' threads. A forked child process cannot use
+    # the threads of its parent; it creates its own executor.
+    def get_executor(self):
+        with self.mLock:
+            if self.mPid != os.getpid():
+                self.mExecutor = concurrent.futures.ThreadPoolExecutor(
+                                   len(self.mClassifiers))
+                self.mPid = os.getpid()
+            return self.mExecutor
+
+    # Classify a list of LoadedImages with all models concurrently, returns
+    # list of results. Concurrent threads can call this method.
+    def predict_batch(self, batch):
+        num_models = len(self.mClassifiers)
+        score_batch = lambda model: self.mClassifiers[model].score_batch(
+                                      self.model_batch(batch, model))
+        if num_models > 1:
+            scores = list(self.get_executor().map(score_batch,
+                                                  range(num_models)))
+        else:
+            scores = [score_batch(0)]
+
+        results = []
+        for i in range(len(batch)):
+            start = time.perf_counter_ns()
+            best_model = None
+            best_score = -1.0
+            for model in range(num_models):
+                image_scores = scores[model][i]
+                if image_scores is None:
+                    continue
+                score = self.mClassifiers[model].mTaxonomy.confidence(
+                          image_scores)
+                if score > best_score:
+                    best_model = model
+                    best_score = score
+            if best_model is None:
+                results.append([])
+            else:
+                results.append(ModelResult(
+                    self.mModel_names[best_model],
+                    self.mClassifiers[best_model].mTaxonomy.prediction(
+                        scores[best_model][i])))
+            instrumentation.record('prediction', start)
+        return results
 
-        if self.mInput_details[0]['dtype'] == np.float32:
-            input_data *= (self.max_pixel_value - self.min_pixel_value) / 255.0
-            input_data += self.min_pixel_value
+#
+# Classification server, keeps the model and the taxonomy loaded.
+#
 
-        self.mInterpreter.set_tensor(self.mInput_details[0]['index'],
-                                     input_data)
-        self.mInterpreter.invoke()
+# Turn a result into a list of dictionaries for JSON output, or into a list of
+# such lists for several hierarchical paths.
+def result_to_dicts(result):
+    if result and isinstance(result[0], list): # top_k paths
+        return [result_to_dicts(path) for path in result]
+    if result and len(result[0]) == 2: # labels only
+        return [{ 'score' : float(score), 'label' : label }
+                for score, label in result]
+    return [{ 'score' : float(score), 'taxon_id' : int(taxon_id),
+              'rank' : rank, 'name' : name }
+            for score, taxon_id, rank, name in result]
+
+# The JSON record of an image and its result; the results of an ensemble also
+# name the model.
+def result_record(image, result):
+    record = { 'image' : image }
+    if isinstance(result, ModelResult):
+        record['model'] = result.model
+    record['result'] = result_to_dicts(result)
+    return record
+
+# An image uploaded in a request; it is referred to by its description in
+# messages.
+class RequestImage(io.BytesIO):
+
+    def __init__(self, data, description):
+        super().__init__(data)
+        self.description = description
+
+    def __str__(self):
+        return self.description
+
+# Serves these requests:
+#   POST /classify  body is an image, returns its classification
+#   POST /classify  body is JSON {"paths": [...]} with image files on this
+#                   host, returns their classifications
+#   GET  /health    returns status and model
+#   GET  /metrics   returns counters and timings
+# The responses are JSON {"results": [{"image": ..., "result": [...]}]}.
+class ClassificationRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def send_json(self, status, response):
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, { 'status' : 'ok',
+                                  'model'  : self.server.model_name })
+        elif self.path == '/metrics':
+            self.send_json(200, self.server.get_metrics())
+        else:
+            self.send_json(404, { 'error' : f"unknown path '{self.path}'" })
 
-        output_data = self.mInterpreter.get_tensor(self.mOutput_details[0]
-                                                   ['index'])
-        path = self.mTaxonomy.prediction(output_data[0])
-        print()
-        print(f"Classification of '{image_filename}' took "
-              f"{time.time() - start_time:.1f} secs.")
-        return path
+    def do_POST(self):
+        if self.path != '/classify':
+            self.send_json(404, { 'error' : f"unknown path '{self.path}'" })
+            return
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            try:
+                images = json.loads(data)['paths']
+                assert type(images) is list
+                assert all(type(image) is str for image in images)
+            except Exception:
+                self.send_json(400, { 'error' : 'expected JSON object with '
+                                                'list "paths" of strings' })
+                return
+            names = images
+        else:
+            images = [RequestImage(data, f'upload from {self.client_address[0]}')]
+            names = [None]
+        try:
+            results = self.server.classify(images)
+        except Exception as e:
+            self.send_json(500, { 'error' : f'classification failed: '
+                                            f'{str(e)}' })
+            return
+        self.send_json(200, { 'results' : [result_record(name, result)
+                                           for name, result in zip(names,
+                                                                   results)] })
+
+    def log_message(self, format, *args):
+        pass # no log line per request
+
+class ClassificationServer(http.server.ThreadingHTTPServer):
+
+    MAX_DELAY = 0.01 # max time in seconds to wait for more images in a batch
+
+    def __init__(self, address, classifier, model_name, batch_size=1):
+        super().__init__(address, ClassificationRequestHandler)
+        self.classifier = classifier
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.queue = queue.Queue() # pairs (image, future)
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.metrics = { 'requests' : 0, 'images' : 0, 'batches' : 0,
+                         'classification_secs' : 0.0 }
+        for _ in range(classifier.get_pool_size()):
+            threading.Thread(target=self.classify_queued_images,
+                             daemon=True).start()
+
+    # Classify images, file names or file objects; called by request handler
+    # threads. Returns list of results.
+    def classify(self, images):
+        futures = []
+        for image in images:
+            futures.append(concurrent.futures.Future())
+            self.queue.put((image, futures[-1]))
+        with self.lock:
+            self.metrics['requests'] += 1
+        return [future.result() for future in futures]
+
+    # There is one of these threads for each interpreter of the classifier.
+    # It combines the images of concurrent requests into batches and
+    # classifies them itself; the threads provide the concurrency.
+    def classify_queued_images(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.MAX_DELAY
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline -
+                                                            time.time())))
+                except queue.Empty:
+                    break
+            start_time = time.time()
+            try:
+                images = [self.classifier.load(image) for image, _ in batch]
+                results = self.classifier.predict_batch(images)
+                elapsed = (time.time() - start_time) / len(batch)
+                for image, (_, future), result in zip(images, batch, results):
+                    future.set_result(result)
+                    if image.pixels is not None or image.scores is not None:
+                        print()
+                        print(f"Classification of '{image.filename}' took "
+                              f"{elapsed:.3f} secs.")
+            except Exception as e:
+                # every request gets an answer and this thread keeps going,
+                # even if the message cannot be printed
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                try:
+                    print(f'Error: classification failed: {str(e)}.')
+                except Exception:
+                    pass
+            with self.lock:
+                self.metrics['images'] += len(batch)
+                self.metrics['batches'] += 1
+                self.metrics['classification_secs'] += time.time() - start_time
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+        metrics['uptime_secs'] = time.time() - self.start_time
+        metrics['queued_images'] = self.queue.qsize()
+        metrics['images_per_batch'] = metrics['images'] / metrics['batches'] \
+                                      if metrics['batches'] else 0.0
+        cache = self.classifier.get_result_cache()
+        if cache:
+            metrics['result_cache_hits'] = cache.hits
+            metrics['result_cache_misses'] = cache.misses
+        metrics['stages'] = instrumentation.summary()
+        return metrics
+
+# Serve classification requests on address [host:]port until interrupted.
+def serve(classifier, model_name, address):
+    host, _, port = address.rpartition(':')
+    server = ClassificationServer((host or '127.0.0.1', int(port)),
+                                  classifier, model_name, batch_size)
+    print(f"Serving model '{model_name}' on http://{server.server_address[0]}:"
+          f"{server.server_address[1]}/classify.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
 
 # Returns a dictionary that maps available classifiers to a pair of filenames.
 def get_installed_models():
@@ -440,20 +1701,262 @@ def get_installed_models():
         sys.exit(1)
     return models
 
-def identify_species(classifier, filename):
-    result = classifier.classify_image(filename)
-    if result:
-        # Print list of tuples (score, taxon id, taxonomic rank, name)
-        # ordered by taxonomic rank from kingdom down to species.
-        for entry in result:
-            if len(entry) == 2: # labels only
-                print(f'{100 * entry[0]:5.1f}% {entry[1]}')
+# Prints the results for `filenames' unless they are written in another
+# output format; calls on_result(filename, result) for each image if given.
+def identify_species(classifier, filenames, on_result=None):
+    for filename, result in classifier.classify_images(filenames, batch_size,
+                                                       loader_threads,
+                                                       queue_depth):
+        if on_result:
+            on_result(filename, result)
+        if output_format != 'text':
+            continue
+        if isinstance(result, ModelResult):
+            print(f"Model '{result.model}':")
+        if result and isinstance(result[0], list): # top_k paths
+            for number, path in enumerate(result, 1):
+                print(f'Path {number}:')
+                print_result(path)
+        else:
+            print_result(result)
+
+# Print list of tuples (score, taxon id, taxonomic rank, name) ordered by
+# taxonomic rank from kingdom down to species.
+def print_result(result):
+    for entry in result:
+        if len(entry) == 2: # labels only
+            print(f'{100 * entry[0]:5.1f}% {entry[1]}')
+            continue
+        print(f'{100 * entry[0]:5.1f}% {entry[2]:11s} {entry[3]}')
+
+# Writes one record per image in JSON Lines or CSV format to a stream. JSON
+# records hold the image and its result as returned by the server, CSV has
+# one row per entry of a result; with several hierarchical paths, a column
+# holds the number of the path. With `models', the results come from an
+# ensemble and CSV has a column for the model. The stream is flushed about
+# once a second so that records are streamed without a system call for each
+# image.
+class ResultWriter:
+
+    FLUSH_INTERVAL = 1.0 # secs
+
+    def __init__(self, stream, format, models=False):
+        self.stream = stream
+        self.format = format
+        self.flushed = time.time()
+        if format == 'csv':
+            self.csv_writer = csv.writer(stream)
+            self.csv_writer.writerow(['image'] +
+                                     (['model'] if models else []) +
+                                     (['score', 'label']
+                                      if label_scores_only else
+                                      ['path', 'score', 'taxon_id', 'rank',
+                                       'name'] if top_k > 1 else
+                                      ['score', 'taxon_id', 'rank', 'name']))
+
+    def write(self, filename, result):
+        if self.format == 'jsonl':
+            self.stream.write(json.dumps(result_record(str(filename),
+                                                       result)) + '\n')
+        else:
+            prefix = [filename]
+            if isinstance(result, ModelResult):
+                prefix.append(result.model)
+            if not result:
+                self.csv_writer.writerow(prefix)
+            elif isinstance(result[0], list): # top_k paths
+                for number, path in enumerate(result_to_dicts(result), 1):
+                    self.csv_writer.writerows(prefix + [number] +
+                                              list(entry.values())
+                                              for entry in path)
+            else:
+                self.csv_writer.writerows(prefix + list(entry.values())
+                                          for entry in result_to_dicts(result))
+        if time.time() - self.flushed >= self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self.stream.flush()
+        self.flushed = time.time()
+
+#
+# Classification in worker processes. The workers are forked after the model's
+# taxonomy and common names have been loaded; they share these read-only, copy
+# on write, with the parent process. Each worker creates its own interpreters.
+#
+
+worker_classifier = None # classifier inherited by forked worker processes
+
+# Runs in a worker process. Classifies a shard of images and returns the
+# output identify_species prints for the shard, the pairs (filename, result),
+# the time the worker spent, the hits and misses of the result cache, and the
+# histograms of the stages.
+def identify_shard(filenames):
+    output = io.StringIO()
+    results = []
+    instrumentation.reset()
+    start_time = time.time()
+    cache = worker_classifier.get_result_cache()
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    with contextlib.redirect_stdout(output):
+        identify_species(worker_classifier, filenames,
+                         lambda filename, result:
+                         results.append((filename, result)))
+    if cache:
+        hits, misses = cache.hits - hits, cache.misses - misses
+    return output.getvalue(), results, time.time() - start_time, hits, \
+           misses, instrumentation.get_histograms()
+
+# Splits the images into shards of consecutive files, classifies the shards
+# in `workers' processes and prints their output in the order of `filenames'.
+# Calls on_result(filename, result) for each image if given.
+def identify_species_in_workers(classifier, filenames, workers,
+                                on_result=None):
+    global worker_classifier
+
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        print('Worker processes are not supported on this platform, '
+              'classifying in a single process.')
+        identify_species(classifier, filenames, on_result)
+        return
+
+    # several shards per worker balance the load, small shards keep the
+    # output flowing
+    shard_size = batch_size * max(1, min(16, math.ceil(len(filenames) /
+                                                       (4 * workers *
+                                                        batch_size))))
+    shards = [filenames[first:first+shard_size]
+              for first in range(0, len(filenames), shard_size)]
+
+    worker_classifier = classifier
+    start_time = time.time()
+    num_images = 0
+    worker_time = 0.0
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        for output, results, shard_time, hits, misses, histograms in \
+                pool.imap(identify_shard, shards):
+            instrumentation.merge(histograms)
+            sys.stdout.write(output)
+            if on_result:
+                for filename, result in results:
+                    on_result(filename, result)
+            num_images += len(results)
+            worker_time += shard_time
+            if classifier.get_result_cache():
+                classifier.get_result_cache().add_counters(hits, misses)
+    elapsed = time.time() - start_time
+
+    print()
+    print(f'Classified {num_images} images with {workers} worker processes '
+          f'in {elapsed:.1f} secs ({num_images / max(elapsed, 1e-9):.1f} '
+          f'images/sec, {worker_time:.1f} secs of worker time).')
+
+# Generates the paths of the image files in `directory' and its
+# subdirectories. Symbolic links to directories are not followed.
+def find_images(directory):
+    directories = [directory]
+    while directories:
+        directory = directories.pop()
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in \
+                         IMAGE_EXTENSIONS and entry.is_file():
+                        yield entry.path
+        except OSError as e:
+            print(f"Error: cannot read directory '{directory}': "
+                  f"{e.strerror}.")
+        # visit subdirectories in the order they were found
+        directories += reversed(subdirectories)
+
+# A manifest records the images that have been classified: their paths, sizes,
+# modification times, the settings, and the results. The settings identify the
+# model and the options that affect the results. Later runs only classify
+# images that are new, have changed, or were classified with other settings,
+# which costs one stat call per unchanged image. The manifest is an SQLite
+# database. Results are committed as they come in; the images a run has yet
+# to classify are kept in table pending, an interrupted run can be resumed
+# without scanning the directories again.
+class Manifest:
+
+    COMMIT_INTERVAL = 64 # results per transaction
+
+    def __init__(self, filename, settings):
+        self.filename = filename
+        self.settings = settings
+        self.uncommitted = 0
+        self.db = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY '
+                        'KEY, size INTEGER, mtime INTEGER, settings TEXT, '
+                        'result TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS pending (seq INTEGER '
+                        'PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime '
+                        'INTEGER)')
+
+    # Returns those of `filenames' that are new or have changed since they
+    # were classified; they become the pending images of this run.
+    def select_images(self, filenames):
+        changed = []
+        selected = []
+        for filename in filenames:
+            path = os.path.abspath(filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
                 continue
-            print(f'{100 * entry[0]:5.1f}% {entry[2]:11s} {entry[3]}')
+            row = self.db.execute('SELECT size, mtime, settings FROM images '
+                                  'WHERE path = ?', (path,)).fetchone()
+            if row != (stat.st_size, stat.st_mtime_ns, self.settings):
+                changed.append((path, stat.st_size, stat.st_mtime_ns))
+                selected.append(filename)
+        self.db.execute('BEGIN')
+        self.db.execute('DELETE FROM pending')
+        self.db.executemany('INSERT OR IGNORE INTO pending (path, size, '
+                            'mtime) VALUES (?, ?, ?)', changed)
+        self.db.execute('COMMIT')
+        return selected
+
+    # Returns the images an interrupted run did not classify.
+    def pending_images(self):
+        return [path for path, in self.db.execute('SELECT path FROM pending '
+                                                  'ORDER BY seq')]
+
+    # Record the result for a pending image. An image that could not be
+    # loaded has an empty result; it is not recorded and stays pending, it
+    # is retried by the next run.
+    def add(self, filename, result):
+        if not result:
+            return
+        path = os.path.abspath(filename)
+        if not self.uncommitted:
+            self.db.execute('BEGIN')
+        row = self.db.execute('SELECT size, mtime FROM pending WHERE path = ?',
+                              (path,)).fetchone()
+        if row:
+            self.db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, '
+                            '?, ?)', (path, row[0], row[1], self.settings,
+                                      json.dumps(result_to_dicts(result))))
+            self.db.execute('DELETE FROM pending WHERE path = ?', (path,))
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        if self.uncommitted:
+            self.db.execute('COMMIT')
+            self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
 
 # command-line parsing
 
-models = get_installed_models()
+models = {} # installed models, discovered by the command-line interface
 
 def model_parameter_check(arg):
     if not arg in models:
@@ -467,11 +1970,32 @@ def model_parameter_check(arg):
         raise argparse.ArgumentTypeError(msg)
     return arg
 
-def result_size_check(arg):
-    if arg.isdigit() and int(arg) > 0 and int(arg) <= 100:
-        return int(arg)
-    raise argparse.ArgumentTypeError(f"'{arg}' is not a number "
-                                     "between 1 and 100.")
+# Returns the type function of an option with an integer between `low' and
+# `high'.
+def int_range_check(low, high):
+    def check(arg):
+        if arg.isdigit() and low <= int(arg) <= high:
+            return int(arg)
+        raise argparse.ArgumentTypeError(f"'{arg}' is not a number "
+                                         f"between {low} and {high}.")
+    return check
+
+def ensemble_check(arg):
+    names = arg.split(',')
+    for name in names:
+        model_parameter_check(name)
+    if len(names) < 2 or len(set(names)) != len(names):
+        raise argparse.ArgumentTypeError(f"'{arg}' is not a list of at least "
+                                         "two different models separated by "
+                                         "commas.")
+    return names
+
+def address_check(arg):
+    host, _, port = arg.rpartition(':')
+    if port.isdigit() and int(port) < 65536:
+        return arg
+    raise argparse.ArgumentTypeError(f"'{arg}' is not a port or "
+                                     "host:port.")
 
 def file_directory_check(arg):
     if os.path.isdir(arg) or os.path.isfile(arg):
@@ -485,6 +2009,8 @@ def file_directory_check(arg):
 if __name__ == '__main__':
     import argparse
 
+    models = get_installed_models()
+
     preferred1 = 'v2_13' # default if this model is available
     preferred2 = 'Seek'  # second preference
 
@@ -496,10 +2022,13 @@ if __name__ == '__main__':
         parser.add_argument("-m", "--model", type=model_parameter_check,
                             default=default_model,
                             help="Model to load to identify organisms.")
-    else: # no default for classification model
+    else: # no default for classification model, required unless --ensemble
         parser.add_argument("-m", "--model", type=model_parameter_check,
-                            required=True,
                             help="Model to load to identify organisms.")
+    parser.add_argument('-e', '--ensemble', metavar='MODELS',
+                        type=ensemble_check, help='Models separated by commas '
+                        'to load together; each image is decoded once and '
+                        'the most confident model is reported.')
     parser.add_argument('-a', '--all_common_names', action="store_true",
                         help='Show all common names and not just one.')
     parser.add_argument('-l', '--label_scores_only', action="store_true",
@@ -508,30 +2037,181 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--scientific_names_only', action="store_true",
                         help='Only use scientific names, do not load common '
                         'names.')
-    parser.add_argument('-r', '--result_size', type=result_size_check,
+    parser.add_argument('-r', '--result_size', type=int_range_check(1, 100),
                         default=result_sz, help='Number of labels and their '
                         'scores to report in results.')
+    parser.add_argument('-k', '--top_k', type=int_range_check(1, 100),
+                        default=top_k, help='Number of hierarchical paths to report: the '
+                        'path reported without this option, then the '
+                        'alternatives ordered by score.')
+    parser.add_argument('--within', metavar='TAXON',
+                        help='Restrict predictions to the taxa below this '
+                        'taxon, given by scientific name or taxon id.')
+    parser.add_argument('-b', '--batch_size', type=int_range_check(1, 1024),
+                        default=batch_size, help='Number of images to '
+                        'classify in one call of the model.')
+    parser.add_argument('-t', '--loader_threads', type=int_range_check(0, 256),
+                        default=loader_threads, help='Number of threads that '
+                        'load and scale images while the model runs; 0 loads '
+                        'images on the main thread.')
+    parser.add_argument('-q', '--queue_depth', type=int_range_check(1, 4096),
+                        default=queue_depth, help='Maximum number of images '
+                        'loaded ahead by the loader threads.')
+    parser.add_argument('-f', '--full_decode', action="store_true",
+                        help='Decode JPEG images at full resolution before '
+                        'scaling them to the model size.')
+    parser.add_argument('-p', '--pool_size', type=int_range_check(1, 256),
+                        default=pool_size, help='Number of interpreters that '
+                        'classify batches of images concurrently.')
+    parser.add_argument('-n', '--num_threads', type=int_range_check(1, 256),
+                        default=num_threads, help='Number of threads each '
+                        'interpreter uses; by default TensorFlow Lite decides.')
+    parser.add_argument('-w', '--workers', type=int_range_check(1, 256),
+                        default=workers, help='Number of worker processes '
+                        'that classify shards of the images.')
+    parser.add_argument('-c', '--cache_results', action="store_true",
+                        help='Cache the scores of classified images and reuse '
+                        'them for images seen before.')
+    parser.add_argument('--format', choices=['text', 'jsonl', 'csv'],
+                        default=output_format, help='Format of the results: '
+                        'text, JSON Lines, or CSV. With jsonl and csv, all '
+                        'other messages go to stderr.')
+    parser.add_argument('--manifest', metavar='FILE',
+                        help='Record classified images and their results in '
+                        'this file and skip unchanged images on later runs.')
+    parser.add_argument('--resume', action="store_true",
+                        help='Continue an interrupted run with the images it '
+                        'has not classified; requires --manifest.')
+    parser.add_argument('--profile', metavar='FILE', nargs='?', const='',
+                        help='Print the time spent in each stage at exit; '
+                        'with FILE, also write cProfile statistics to FILE.')
+    parser.add_argument('--serve', metavar='[HOST:]PORT', type=address_check,
+                        help='Keep the model loaded and serve classification '
+                        'requests over HTTP on this port.')
     parser.add_argument('files_dirs', metavar='file/directory',
-                        type=file_directory_check, nargs='+',
+                        type=file_directory_check, nargs='*',
                         help='Image files or directories with images.')
     args = parser.parse_args()
+    if not args.model and not args.ensemble:
+        parser.error('the following arguments are required: -m/--model')
+    if not args.files_dirs and not args.serve and not args.resume:
+        parser.error('the following arguments are required: file/directory')
+    if args.resume and not args.manifest:
+        parser.error('argument --resume: requires argument --manifest')
+    if args.serve and args.workers > 1:
+        parser.error('argument -w/--workers: not allowed with argument '
+                     '--serve')
 
     scientific_names_only = args.scientific_names_only
     label_scores_only = args.label_scores_only
     all_common_names = args.all_common_names
     result_sz = args.result_size
+    top_k = args.top_k
+    within = args.within
+    batch_size = args.batch_size
+    loader_threads = args.loader_threads
+    queue_depth = args.queue_depth
+    full_decode = args.full_decode
+    pool_size = args.pool_size
+    num_threads = args.num_threads
+    workers = args.workers
+    cache_results = args.cache_results
+    output_format = args.format
+
+    results_stream = sys.stdout
+    if output_format != 'text':
+        # results go to stdout, all other messages to stderr
+        sys.stdout = sys.stderr
+
+    if args.profile is not None:
+        import atexit, cProfile
+        profiler = None
+        if args.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        def report_profile():
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(args.profile)
+                print(f"\nWrote profile to '{args.profile}'.")
+            instrumentation.report()
+
+        atexit.register(report_profile)
 
     # make classifier instance
 
-    classifier = OfflineClassifier(models[args.model])
+    result_cache = ResultCache(os.path.join(CACHE_DIR, 'results.sqlite')) \
+                   if cache_results else None
+    if args.ensemble:
+        model_name = ','.join(args.ensemble)
+        classifier = EnsembleClassifier([OfflineClassifier(models[name],
+                                                           pool_size,
+                                                           num_threads,
+                                                           result_cache,
+                                                           batch_size)
+                                         for name in args.ensemble],
+                                        args.ensemble)
+    else:
+        model_name = args.model
+        classifier = OfflineClassifier(models[args.model], pool_size,
+                                       num_threads, result_cache, batch_size)
+    if within is not None and not classifier.restrict(within):
+        sys.exit(1)
+
+    if args.serve:
+        serve(classifier, model_name, args.serve)
+        sys.exit(0)
 
     # process photos
 
-    for arg in args.files_dirs:
-        if os.path.isfile(arg):
-            identify_species(classifier, arg)
-        elif os.path.isdir(arg):
-            for file in os.listdir(arg):
-                ext = os.path.splitext(file)[1].lower()
-                if ext in ['.jpg', '.jepg', '.png']:
-                    identify_species(classifier, os.path.join(arg, file))
+    manifest = None
+    writer = None
+    filenames = []
+    if args.manifest:
+        manifest = Manifest(args.manifest, f'{classifier.get_model_id()}:'
+                            f'{scientific_names_only}:{label_scores_only}:'
+                            f'{all_common_names}:{result_sz}:{top_k}:'
+                            f'{within}')
+        if args.resume:
+            filenames = manifest.pending_images()
+            print(f"Resuming with {len(filenames)} images from manifest "
+                  f"'{args.manifest}'.")
+
+    if not filenames:
+        for arg in args.files_dirs:
+            if os.path.isfile(arg):
+                filenames.append(arg)
+            elif os.path.isdir(arg):
+                filenames += find_images(arg)
+
+        if manifest:
+            num_images = len(filenames)
+            filenames = manifest.select_images(filenames)
+            print(f"Manifest '{args.manifest}': {len(filenames)} of "
+                  f"{num_images} images are new or have changed.")
+
+    if output_format != 'text':
+        writer = ResultWriter(results_stream, output_format,
+                              args.ensemble is not None)
+
+    def on_result(filename, result):
+        if manifest:
+            manifest.add(filename, result)
+        if writer:
+            writer.write(filename, result)
+
+    if workers > 1:
+        identify_species_in_workers(classifier, filenames, workers, on_result)
+    else:
+        identify_species(classifier, filenames, on_result)
+
+    if manifest:
+        manifest.close()
+    if writer:
+        writer.flush()
+
+    if result_cache:
+        print()
+        print(f'Result cache: {result_cache.hits} hits, '
+              f'{result_cache.misses} misses.')
@@ -0,0 +1,85 @@
+import contextlib, os, sqlite3, threading
+
+#############################################################################
+#                                                                           #
+# Caches in SQLite databases, shared by the cache of API responses and the  #
+# cache of classification results. A database is in WAL mode, several      #
+# processes can share it. Table total holds the total size of the entries;  #
+# when it exceeds the maximum size, the least recently used entries are     #
+# evicted.                                                                  #
+#                                                                           #
+#############################################################################
+
+class SqliteCache:
+
+    TABLE    = None  # table of the entries with columns key and accessed
+    SIZE     = None  # SQL expression for the size of an entry
+    EVICT_TO = 0.9   # evict entries down to this fraction of the max size
+
+    def __init__(self, filename, max_size):
+        self.filename = filename
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = None
+        self.pid = None
+
+    # Create the table of the entries and any other tables of a subclass.
+    def create_tables(self, db):
+        raise NotImplementedError
+
+    # connect on first use, reconnect in a forked child process
+    def connect(self):
+        if self.db is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            self.db = sqlite3.connect(self.filename, timeout=60,
+                                      check_same_thread=False,
+                                      isolation_level=None)
+            self.pid = os.getpid()
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.create_tables(self.db)
+            self.db.execute(f'CREATE INDEX IF NOT EXISTS {self.TABLE}_accessed '
+                            f'ON {self.TABLE} (accessed)')
+            # total size of all entries, summed up once for older databases
+            self.db.execute('CREATE TABLE IF NOT EXISTS total (id INTEGER '
+                            'PRIMARY KEY CHECK (id = 0), size INTEGER)')
+            self.db.execute(f'INSERT OR IGNORE INTO total SELECT 0, '
+                            f'COALESCE(SUM({self.SIZE}), 0) FROM {self.TABLE}')
+        return self.db
+
+    # A write transaction, entered with the lock held; yields the database.
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            db = self.connect()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+                db.execute('COMMIT')
+            except:
+                db.execute('ROLLBACK')
+                raise
+
+    # Add `size' to the total size; called in a transaction.
+    @staticmethod
+    def add_size(db, size):
+        db.execute('UPDATE total SET size = size + ?', (size,))
+
+    # Evict the least recently used entries if the total size exceeds the
+    # maximum size; called in a transaction.
+    def evict(self, db):
+        size = db.execute('SELECT size FROM total').fetchone()[0]
+        if size <= self.max_size:
+            return
+        for key, entry_size in db.execute(f'SELECT key, {self.SIZE} FROM '
+                                          f'{self.TABLE} ORDER BY accessed').\
+                                          fetchall():
+            if size <= self.EVICT_TO * self.max_size:
+                break
+            db.execute(f'DELETE FROM {self.TABLE} WHERE key = ?', (key,))
+            size -= entry_size
+        db.execute('UPDATE total SET size = ?', (size,))
+
+
+if __name__ == '__main__':
+
+    assert not 'Not a top-level Python module!'
@@ -0,0 +1,177 @@
+import http.server, json, os, sys, tempfile, threading, time, unittest
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inat_api
+
+#############################################################################
+#                                                                           #
+# Tests of the API client against a local stub of the iNaturalist API. The  #
+# stub answers taxa by id and name searches, answers the first request for  #
+# the id TOO_MANY with error 429, and answers requests for the id SLOW      #
+# late.                                                                     #
+#                                                                           #
+#############################################################################
+
+TOO_MANY = 999
+SLOW     = 998
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        with server.lock:
+            server.requests.append(self.path)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(0.01) # let concurrent requests overlap
+            if url.path.startswith('/v1/taxa/'):
+                ids = [int(id) for id in
+                       urllib.parse.unquote(url.path[9:]).split(',')]
+                with server.lock:
+                    too_many = TOO_MANY in ids and not server.refused
+                    server.refused = server.refused or too_many
+                if too_many:
+                    self.send_json(429, { 'error' : 'too many requests' })
+                    return
+                if SLOW in ids:
+                    time.sleep(0.5)
+                results = [{ 'id' : id, 'name' : f'Taxon{id}',
+                             'rank_level' : 10 } for id in ids]
+            else:
+                query = urllib.parse.parse_qs(url.query)
+                results = [{ 'id' : 1, 'name' : query['q'][0],
+                             'rank_level' : 10 }]
+            self.send_json(200, { 'total_results' : len(results),
+                                  'results' : results })
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def send_json(self, status, response):
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestThrottle(unittest.TestCase):
+
+    def test_calls_per_interval(self):
+        throttle = inat_api.Throttle()
+        throttle.API_MAX_CALLS = 10
+        throttle.API_INTERVAL = 0.2
+        times = []
+        lock = threading.Lock()
+
+        def call():
+            for _ in range(10):
+                throttle.wait()
+                with lock:
+                    times.append(time.monotonic())
+
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        times.sort()
+        self.assertEqual(len(times), 40)
+        # any API_MAX_CALLS+1 consecutive calls span at least API_INTERVAL
+        for first in range(len(times) - throttle.API_MAX_CALLS):
+            self.assertGreaterEqual(times[first + throttle.API_MAX_CALLS] -
+                                    times[first],
+                                    throttle.API_INTERVAL - 1e-3)
+
+    def test_backoff(self):
+        throttle = inat_api.Throttle()
+        throttle.backoff(0.2)
+        start = time.monotonic()
+        throttle.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.2 - 1e-3)
+        start = time.monotonic()
+        throttle.wait()
+        self.assertLess(time.monotonic() - start, 0.1)
+
+class TestApiClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      StubHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.active = 0
+        self.server.max_active = 0
+        self.server.refused = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.saved = (inat_api.API_HOST, inat_api.cache,
+                      inat_api.api_call_throttle, inat_api.API_MAX_IDS,
+                      inat_api.TOO_MANY_API_CALLS_DELAY, inat_api.API_TIMEOUT)
+        inat_api.API_HOST = f'http://127.0.0.1:{self.server.server_address[1]}'\
+                            '/v1'
+        inat_api.cache = inat_api.ApiCache(os.path.join(self.tmpdir.name,
+                                                        'api_cache.sqlite'))
+        inat_api.api_call_throttle = inat_api.Throttle()
+        inat_api.api_call_throttle.API_MAX_CALLS = 20
+        inat_api.api_call_throttle.API_INTERVAL = 0.2
+        inat_api.API_MAX_IDS = 3
+        inat_api.TOO_MANY_API_CALLS_DELAY = 0.01
+        inat_api.API_TIMEOUT = 0.2
+
+    def tearDown(self):
+        (inat_api.API_HOST, inat_api.cache, inat_api.api_call_throttle,
+         inat_api.API_MAX_IDS, inat_api.TOO_MANY_API_CALLS_DELAY,
+         inat_api.API_TIMEOUT) = self.saved
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def test_taxa_by_ids(self):
+        ids = list(range(1, 61)) + [TOO_MANY]
+        taxa = inat_api.get_taxa_by_ids(ids + ids[:5])
+        self.assertEqual(sorted(taxa), ids)
+        self.assertEqual(taxa[7]['name'], 'Taxon7')
+        self.assertTrue(self.server.refused)           # 429 was retried
+        self.assertGreater(self.server.max_active, 1)  # concurrent calls
+
+        # taxa are cached individually
+        num_requests = len(self.server.requests)
+        self.assertEqual(inat_api.get_taxa_by_id(7)['results'][0]['name'],
+                         'Taxon7')
+        self.assertEqual(inat_api.get_taxa_by_ids(ids), taxa)
+        self.assertEqual(len(self.server.requests), num_requests)
+
+    def test_timeout(self):
+        self.assertIsNone(inat_api.get_taxa_by_id(SLOW))
+        self.assertEqual(inat_api.get_taxa_by_id(8)['results'][0]['name'],
+                         'Taxon8')
+
+    def test_resolver(self):
+        resolver = inat_api.TaxaResolver()
+        for id in [3, 4, 3]:
+            resolver.add_id(id)
+        for name in ['Bellis perennis', 'Primula', 'Primula']:
+            resolver.add_name(name)
+        taxa = resolver.resolve()
+        self.assertEqual(sorted(taxa), [3, 4])
+
+        # name searches are served from the cache afterwards
+        num_requests = len(self.server.requests)
+        response = inat_api.get_taxa(inat_api.name_query('Primula'))
+        self.assertEqual(response['results'][0]['name'], 'Primula')
+        self.assertEqual(len(self.server.requests), num_requests)
+        self.assertEqual(sum(request.startswith('/v1/taxa?')
+                             for request in self.server.requests), 2)
+
+if __name__ == '__main__':
+    unittest.main()
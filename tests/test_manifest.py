@@ -0,0 +1,93 @@
+import os, sqlite3, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nature_id
+
+#############################################################################
+#                                                                           #
+# Tests of the manifest of classified images: later runs select only new    #
+# and changed images and images classified with other settings, an          #
+# interrupted run resumes with its pending images, and images that could    #
+# not be loaded are retried.                                                #
+#                                                                           #
+#############################################################################
+
+RESULT = [(0.9, 47126, 'kingdom', 'Plantae'),
+          (0.8, 47125, 'phylum', 'Tracheophyta')]
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.manifest_file = os.path.join(self.tmpdir.name, 'test.manifest')
+        self.images = []
+        for i in range(4):
+            self.images.append(os.path.join(self.tmpdir.name, f'{i}.jpg'))
+            self.write_image(i, b'image')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_image(self, i, data):
+        with open(self.images[i], 'wb') as f:
+            f.write(data)
+
+    def manifest(self, settings='plants:1'):
+        return nature_id.Manifest(self.manifest_file, settings)
+
+    def test_select_images(self):
+        manifest = self.manifest()
+        self.assertEqual(manifest.select_images(self.images), self.images)
+        for image in self.images:
+            manifest.add(image, RESULT)
+        manifest.close()
+
+        manifest = self.manifest()
+        self.assertEqual(manifest.select_images(self.images), [])
+        self.write_image(2, b'changed image')
+        new_image = os.path.join(self.tmpdir.name, 'new.jpg')
+        with open(new_image, 'wb') as f:
+            f.write(b'image')
+        self.assertEqual(manifest.select_images(self.images + [new_image]),
+                         [self.images[2], new_image])
+        manifest.close()
+
+        # other settings
+        manifest = self.manifest('plants:3')
+        self.assertEqual(manifest.select_images(self.images), self.images)
+        manifest.close()
+
+    def test_resume(self):
+        manifest = self.manifest()
+        manifest.select_images(self.images)
+        manifest.add(self.images[0], RESULT)
+        manifest.add(self.images[2], [])     # could not be loaded
+        manifest.close()                     # interrupted
+
+        manifest = self.manifest()
+        self.assertEqual(manifest.pending_images(),
+                         [self.images[1], self.images[2], self.images[3]])
+        for image in manifest.pending_images():
+            manifest.add(image, RESULT)
+        self.assertEqual(manifest.pending_images(), [])
+        manifest.close()
+
+        db = sqlite3.connect(self.manifest_file)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM images').fetchone(),
+                         (4,))
+        db.close()
+
+    def test_failed_images_are_retried(self):
+        manifest = self.manifest()
+        manifest.select_images(self.images)
+        for image in self.images:
+            manifest.add(image, [] if image == self.images[1] else RESULT)
+        manifest.close()
+
+        manifest = self.manifest()
+        self.assertEqual(manifest.select_images(self.images), [self.images[1]])
+        manifest.close()
+
+if __name__ == '__main__':
+    unittest.main()
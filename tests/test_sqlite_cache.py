@@ -0,0 +1,80 @@
+import os, sqlite3, sys, tempfile, time, unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inat_api, nature_id
+
+#############################################################################
+#                                                                           #
+# Tests of the caches in SQLite databases: the total size kept in table     #
+# total matches the entries, and the least recently used entries are        #
+# evicted.                                                                  #
+#                                                                           #
+#############################################################################
+
+class TestSqliteCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def filename(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def assertTotal(self, cache):
+        db = cache.connect()
+        total = db.execute('SELECT size FROM total').fetchone()[0]
+        size = db.execute(f'SELECT COALESCE(SUM({cache.SIZE}), 0) FROM '
+                          f'{cache.TABLE}').fetchone()[0]
+        self.assertEqual(total, size)
+        return total
+
+    def test_api_cache(self):
+        cache = inat_api.ApiCache(self.filename('api.sqlite'), max_size=2000)
+        for i in range(20):
+            cache.put(f'key{i % 15}', { 'results' : ['x' * (10 * i)] })
+            self.assertLessEqual(self.assertTotal(cache), 2000)
+        self.assertEqual(cache.get('key14'), { 'results' : ['x' * 140] })
+        self.assertIsNone(cache.get('key5'))   # evicted
+
+        # expired entries are deleted on the next put
+        expiring = inat_api.ApiCache(self.filename('api.sqlite'),
+                                     expiration=0)
+        expiring.put('old', { 'results' : [] })
+        time.sleep(0.01)
+        cache.put('new', { 'results' : [] })
+        self.assertIsNone(cache.get('old'))
+        self.assertTotal(cache)
+
+    def test_result_cache(self):
+        cache = nature_id.ResultCache(self.filename('results.sqlite'),
+                                      max_size=1000)
+        scores = np.arange(25, dtype=np.float32) # 100 bytes
+        cache.put([(f'key{i}', scores) for i in range(5)])
+        cache.put([('key0', scores)])            # already cached
+        self.assertEqual(self.assertTotal(cache), 500)
+        cache.get('key0')                        # key0 is used again
+        cache.put([(f'key{i}', scores) for i in range(5, 12)])
+        self.assertLessEqual(self.assertTotal(cache), 900)
+        np.testing.assert_array_equal(cache.get('key0'), scores)
+        self.assertIsNone(cache.get('key1'))     # evicted
+
+    def test_total_of_older_database(self):
+        filename = self.filename('api.sqlite')
+        db = sqlite3.connect(filename)
+        db.execute('CREATE TABLE cache (key TEXT PRIMARY KEY, expires REAL, '
+                   'accessed REAL, size INTEGER, value TEXT)')
+        db.execute('INSERT INTO cache VALUES (?, ?, ?, ?, ?)',
+                   ('key', time.time() + 100, time.time(), 2, '{}'))
+        db.commit()
+        db.close()
+        cache = inat_api.ApiCache(filename)
+        self.assertEqual(self.assertTotal(cache), 2)
+        self.assertEqual(cache.get('key'), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+import csv, os, sys, tempfile, unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inat_taxonomy, nature_id
+
+#############################################################################
+#                                                                           #
+# Tests of the compiled taxonomy on a tiny tree. The propagated scores and  #
+# the predictions are compared with a straightforward recursive traversal   #
+# of the taxa; best_paths (option -k) with a search of all candidate paths; #
+# restricted predictions (option --within) with predictions for the scores  #
+# of the clade alone. Snapshots must be rebuilt when the taxonomy file      #
+# changes and only rehashed when it is touched.                             #
+#                                                                           #
+#############################################################################
+
+# taxon id -> [parent id, rank level, leaf class ids, name], in pre-order
+TAXA = {
+    1  : [None, 70, [],     'Plantae'],
+    2  : [1,    40, [],     'Asterales'],
+    3  : [2,    30, [],     'Asteraceae'],
+    4  : [3,    20, [],     'Bellis'],
+    5  : [4,    10, [0],    'Bellis perennis'],
+    6  : [4,    10, [1],    'Bellis annua'],
+    15 : [4,    10, [7],    'Bellis sylvestris'],
+    7  : [3,    20, [],     'Solidago'],
+    8  : [7,    10, [2],    'Solidago velutina'],
+    9  : [1,    40, [],     'Ericales'],
+    10 : [9,    30, [],     'Primulaceae'],
+    11 : [10,   20, [3],    'Primula'],
+    12 : [11,   10, [4, 6], 'Primula hendersonii'],
+    16 : [1,    40, [],     'Lamiales'],
+    17 : [16,   30, [8],    'Lamiaceae'],
+    13 : [None, 70, [],     'Fungi'],
+    14 : [13,   20, [5],    'Bellis'],  # homonym of the plant genus
+}
+
+NUM_LABELS = 9
+
+def children_of(taxon_id):
+    return [child for child, taxon in TAXA.items() if taxon[0] == taxon_id]
+
+# Score of a taxon: its labels' scores and the scores of its children.
+def recursive_score(taxon_id, scores):
+    return sum(scores[label] for label in TAXA[taxon_id][2]) + \
+           sum(recursive_score(child, scores)
+               for child in children_of(taxon_id))
+
+# The path guided by scores: descend to the best child unless the other
+# children combined are better. Returns pairs (taxon id, score).
+def recursive_path(scores):
+    total = sum(recursive_score(child, scores) for child in children_of(None))
+    path = []
+    taxon_id, score = None, total
+    while children_of(taxon_id):
+        best_child, best_score = None, -1.0
+        for child in children_of(taxon_id):
+            child_score = recursive_score(child, scores)
+            if child_score > best_score:
+                best_child, best_score = child, child_score
+        if best_score < 0.5 * score:
+            break
+        path.append((best_child, best_score / total))
+        taxon_id, score = best_child, best_score
+    return path
+
+def random_scores(rng):
+    return rng.dirichlet(np.full(NUM_LABELS, 0.3)).astype(np.float32)
+
+class TestTaxonomy(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (nature_id.top_k, nature_id.scientific_names_only)
+        nature_id.scientific_names_only = True
+        self.taxonomy = nature_id.Taxonomy()
+        self.taxonomy.compile_tree(TAXA)
+        self.rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        nature_id.top_k, nature_id.scientific_names_only = self.saved
+
+    def test_compile_tree(self):
+        taxonomy = self.taxonomy
+        self.assertEqual(taxonomy.taxon_ids.tolist(),
+                         [inat_taxonomy.ROOT_TAXON_ID] + list(TAXA))
+        for idx in range(1, len(taxonomy.taxon_ids)):
+            parent_idx = taxonomy.parent_indices[idx]
+            parent_id = TAXA[taxonomy.taxon_ids[idx]][0]
+            self.assertEqual(taxonomy.taxon_ids[parent_idx],
+                             inat_taxonomy.ROOT_TAXON_ID if parent_id is None
+                             else parent_id)
+            self.assertEqual(taxonomy.depths[idx],
+                             taxonomy.depths[parent_idx] + 1)
+            self.assertEqual(taxonomy.get_taxon(idx).name,
+                             TAXA[taxonomy.taxon_ids[idx]][3])
+            # the subtree is a range of indices
+            self.assertLessEqual(taxonomy.subtree_ends[idx],
+                                 taxonomy.subtree_ends[parent_idx])
+        for label in range(NUM_LABELS):
+            taxon_id = taxonomy.taxon_ids[taxonomy.label_taxon_indices[label]]
+            self.assertIn(label, TAXA[taxon_id][2])
+
+    def test_compute_scores(self):
+        for _ in range(20):
+            scores = random_scores(self.rng)
+            taxon_scores = self.taxonomy.compute_scores(scores)
+            expected = [recursive_score(taxon_id, scores)
+                        for taxon_id in self.taxonomy.taxon_ids[1:].tolist()]
+            np.testing.assert_allclose(taxon_scores[1:], expected, rtol=1e-6)
+            np.testing.assert_allclose(taxon_scores[0], np.sum(scores),
+                                       rtol=1e-6)
+
+    def test_prediction(self):
+        for _ in range(100):
+            scores = random_scores(self.rng)
+            result = self.taxonomy.prediction(scores)
+            expected = recursive_path(scores)
+            self.assertEqual([taxon_id for _, taxon_id, _, _ in result],
+                             [taxon_id for taxon_id, _ in expected])
+            np.testing.assert_allclose([score for score, _, _, _ in result],
+                                       [score for _, score in expected],
+                                       rtol=1e-6)
+            self.assertEqual([name for _, _, _, name in result],
+                             [TAXA[taxon_id][3] for taxon_id, _ in expected])
+
+    def test_best_paths(self):
+        taxonomy = self.taxonomy
+        for _ in range(100):
+            scores = random_scores(self.rng)
+            nature_id.top_k = 1
+            single = taxonomy.prediction(scores)
+            nature_id.top_k = 4
+            paths = taxonomy.prediction(scores)
+
+            # the first path is the one reported without option -k; it is
+            # empty when no kingdom has half of the score
+            if single:
+                self.assertEqual(paths[0], single)
+                alternatives = paths[1:]
+            else:
+                alternatives = paths
+
+            # the alternatives are the best other paths ending at a leaf
+            # taxon or where a path would be truncated
+            taxon_scores = taxonomy.compute_scores(scores)
+            ends = []
+            for idx in range(1, len(taxon_scores)):
+                children = taxonomy.child_indices[
+                             taxonomy.child_offsets[idx]:
+                             taxonomy.child_offsets[idx+1]]
+                if taxon_scores[idx] > 0 and (len(children) == 0 or
+                   taxon_scores[children].max() < 0.5 * taxon_scores[idx]):
+                    ends.append((-taxon_scores[idx], idx))
+            ends.sort()
+            expected = [taxonomy.taxon_ids[idx] for _, idx in ends
+                        if not single or
+                           taxonomy.taxon_ids[idx] != single[-1][1]]
+            self.assertEqual([path[-1][1] for path in alternatives],
+                             expected[:len(alternatives)])
+            self.assertEqual(len(paths), min(4, len(expected) + bool(single)))
+
+    def test_restrict(self):
+        taxonomy = self.taxonomy
+        self.assertTrue(taxonomy.restrict('Asteraceae'))
+        clade_labels = [0, 1, 2, 7]
+        for _ in range(50):
+            scores = random_scores(self.rng)
+            result = taxonomy.prediction(scores)
+
+            # the path starts with the clade and its ancestors
+            self.assertEqual([(score, taxon_id) for score, taxon_id, _, _
+                              in result[:3]], [(1.0, 1), (1.0, 2), (1.0, 3)])
+
+            # the path is that of the clade's scores alone
+            masked = np.zeros_like(scores)
+            masked[clade_labels] = scores[clade_labels]
+            expected = recursive_path(masked)
+            self.assertEqual([taxon_id for _, taxon_id, _, _ in result],
+                             [taxon_id for taxon_id, _ in expected])
+            np.testing.assert_allclose([score for score, _, _, _ in result],
+                                       [score for _, score in expected],
+                                       rtol=1e-6)
+            self.assertAlmostEqual(taxonomy.confidence(scores),
+                                   scores[clade_labels].max() /
+                                   scores[clade_labels].sum(), places=6)
+
+        # by taxon id, back to the whole tree with the root
+        self.assertTrue(taxonomy.restrict(7))
+        result = taxonomy.prediction(random_scores(self.rng))
+        self.assertEqual(result[-1][1], 8)
+        self.assertTrue(taxonomy.restrict(inat_taxonomy.ROOT_TAXON_ID))
+        scores = random_scores(self.rng)
+        self.assertEqual([taxon_id for _, taxon_id, _, _
+                          in taxonomy.prediction(scores)],
+                         [taxon_id for taxon_id, _ in recursive_path(scores)])
+
+        # unknown and ambiguous names
+        self.assertFalse(taxonomy.restrict('Quercus'))
+        self.assertFalse(taxonomy.restrict('Bellis'))
+        self.assertTrue(taxonomy.restrict('Bellis perennis'))
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = nature_id.scientific_names_only
+        nature_id.scientific_names_only = True
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'taxonomy_test.csv')
+        self.write_csv(TAXA)
+
+    def tearDown(self):
+        nature_id.scientific_names_only = self.saved
+        self.tmpdir.cleanup()
+
+    def write_csv(self, taxa):
+        with open(self.filename, 'w', newline='', encoding='latin-1') as f:
+            writer = csv.writer(f)
+            writer.writerow(['parent_taxon_id', 'taxon_id', 'rank_level',
+                             'leaf_class_id', 'name'])
+            for taxon_id, (parent_id, rank_level, labels, name) in \
+                    taxa.items():
+                writer.writerow(['' if parent_id is None else parent_id,
+                                 taxon_id, rank_level,
+                                 ';'.join(str(label) for label in labels),
+                                 name])
+
+    # Reads the taxonomy, returns whether the snapshot was used and the
+    # number of times the taxonomy file was hashed.
+    def read(self):
+        taxonomy = nature_id.Taxonomy()
+        with mock.patch.object(nature_id.Taxonomy, 'file_hash',
+                               side_effect=nature_id.Taxonomy.file_hash) \
+                as file_hash:
+            used = taxonomy.read_snapshot(self.filename)
+        if not used:
+            taxonomy.read_taxonomy(self.filename)
+        self.taxonomy = taxonomy
+        return used, file_hash.call_count
+
+    def test_snapshot(self):
+        self.assertEqual(self.read(), (False, 0)) # parsed, snapshot written
+        self.assertTrue(os.path.isfile(
+            nature_id.Taxonomy.snapshot_filename(self.filename)))
+        self.assertEqual(self.read(), (True, 0))
+
+        # touched: hashed once, then the snapshot is up to date again
+        stat = os.stat(self.filename)
+        os.utime(self.filename, ns=(stat.st_atime_ns,
+                                    stat.st_mtime_ns + 10**9))
+        self.assertEqual(self.read(), (True, 1))
+        self.assertEqual(self.read(), (True, 0))
+
+        # changed: the taxonomy is parsed again
+        taxa = dict(TAXA)
+        taxa[8] = [7, 10, [2], 'Solidago californica']
+        self.write_csv(taxa)
+        self.assertEqual(self.read(), (False, 1))
+        indices = self.taxonomy.find_name('Solidago californica')
+        self.assertEqual(self.taxonomy.taxon_ids[indices].tolist(), [8])
+        self.assertEqual(self.read(), (True, 0))
+
+if __name__ == '__main__':
+    unittest.main()